@@ -0,0 +1,43 @@
+# turns a generated, deeply nested code block back into source with
+# as_src. The time should grow linearly with the size of the source it
+# makes, at a few nanoseconds a character; the source itself grows
+# quadratically with the number of levels, since each level is indented
+# one step further than the one around it
+#
+# usage: python benchmarks/as_src.py
+
+import os
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+sys.path.insert(0, os.path.join(here, ".."))
+
+from stekk.parser import parse, CodeBlock, FcallExpr
+from stekk.vm import VM
+
+STATEMENTS = parse('x := (x 1 .+); (x .println); if (x 3 .>) { y := x; } else { y := 0; };')
+
+def generated(levels):
+    block = CodeBlock(list(STATEMENTS))
+    for _ in range(levels):
+        block = CodeBlock([*STATEMENTS, FcallExpr(block)])
+    return block
+
+def timed(levels):
+    vm = VM([], printer=lambda *values, end="\n": None)
+    vm.names["generated"] = generated(levels)
+    vm.statements.extend(parse("src := (generated .as_src);"))
+    start = time.perf_counter()
+    vm.run()
+    return time.perf_counter() - start, len(str(vm.names["src"]))
+
+def main():
+    sys.setrecursionlimit(100_000)
+    for levels in (250, 500, 1000, 2000):
+        seconds, size = timed(levels)
+        print(f"{levels:6} levels  {seconds * 1000:8.1f} ms  "
+              f"{size:11,} characters  {seconds / size * 1e9:5.1f} ns each")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# times the built-ins that go through the arithmetic backend, with
+# Python ints and with gmpy2 on every call, to find the operand sizes
+# where gmpy2 starts to win (the thresholds in stekk/arithmetic.py)
+#
+# usage: python benchmarks/bigint.py   (needs gmpy2)
+
+import os
+import random
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+sys.path.insert(0, os.path.join(here, ".."))
+
+from stekk.arithmetic import PythonArithmetic, GmpArithmetic
+
+def timed(function, *args):
+    """seconds per call"""
+    runs = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(runs):
+            function(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0.05:
+            return elapsed / runs
+        runs *= 4
+
+def operands(bits):
+    return (random.getrandbits(2 * bits) | 1, random.getrandbits(bits) | 1)
+
+def main():
+    python = PythonArithmetic()
+    gmp = GmpArithmetic()
+    gmp.MUL_THRESHOLD = gmp.DIV_THRESHOLD = gmp.POWMOD_THRESHOLD = 0
+
+    cases = [
+        ("*", lambda backend, a, b: backend.mul(b, b)),
+        ("/i", lambda backend, a, b: backend.floordiv(a, b)),
+        ("mod", lambda backend, a, b: backend.mod(a, b)),
+        ("powmod", lambda backend, a, b: backend.powmod(a, b, b)),
+    ]
+    print(f"{'':8}{'bits':>8}{'python':>12}{'gmpy2':>12}{'speedup':>10}")
+    for name, case in cases:
+        sizes = [64, 256, 1024, 4096, 16384, 65536, 262144]
+        if name == "powmod":
+            sizes = [64, 128, 256, 512, 1024, 2048, 4096]
+        for bits in sizes:
+            a, b = operands(bits)
+            slow = timed(case, python, a, b)
+            fast = timed(case, gmp, a, b)
+            print(f"{name:8}{bits:8}{slow * 1e6:10.2f}us{fast * 1e6:10.2f}us"
+                  f"{slow / fast:9.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+# runs a corpus of programs through every engine configuration and
+# checks that they all end with the same output, stack, names and last
+# result as the plain interpreter; the time each engine took is compared
+# with a stored baseline
+#
+# the corpus is the examples, the code snippets of the tutorial, a few
+# programs below and randomly generated ones. The other engines' timings
+# are stored relative to the reference engine's in the same run, and the
+# reference's relative to a plain Python loop, so the baseline roughly
+# carries over between machines; it's only compared with runs over the
+# same corpus
+#
+# usage: python benchmarks/conformance.py [--random=N] [--seed=N]
+#            [--repeat=N] [--threshold=F] [--update-baseline] [--verbose]
+
+import contextlib
+import copy
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+sys.path.insert(0, os.path.join(here, ".."))
+
+from stekk import server
+from stekk.arithmetic import get_arithmetic
+from stekk.parser import Const, StekkSyntaxError, parse
+from stekk.vm import VM, vm_builtins
+
+ROOT = os.path.join(here, "..")
+BASELINE_PATH = os.path.join(here, "conformance_baseline.json")
+
+OPERATIONS_LIMIT = 200_000
+
+# programs also run the way a server worker runs them
+SERVED = ["parallel"]
+
+# programs that have to stop at a memory limit, in bytes
+OVER_LIMIT = {"local-memory": 400_000, "collect-memory": 100_000,
+              "join-memory": 100_000, "stack-memory": 100_000}
+
+# engine -> VM options; the first one is the reference
+ENGINES = {
+    "interpreter": {},
+    "jit": {"jit_threshold": 1},
+    "jit-tiered": {"jit_threshold": 3},
+    "gmpy2": {"arithmetic": "gmpy2"},
+    "gmpy2-jit": {"arithmetic": "gmpy2", "jit_threshold": 1},
+    "parallel": {"workers": 2, "chunk_size": 1},
+    "memory-limit": {"memory_limit": 1 << 30},
+}
+
+PROGRAMS = {
+    "underflow": """
+        (.+);
+        x := (1 .swap);
+        (.drop .drop .dup);
+    """,
+    "type-errors": """
+        ("a" 1 .+);
+        ([1] "b" .-);
+        x := ([1 2] 3 .mod);
+    """,
+    "error-stack": """
+        (2 { (12 "ab" 0 .mod); } .times);
+        (3 { (12 0 .dup .mod); } .times);
+    """,
+    "error-name": """
+        (3 { (12 x); } .times);
+    """,
+    "last-result": """
+        (1 2 3);
+        x := 4;
+        (x 5 .*);
+    """,
+    "loops": """
+        total := 0;
+        (1..50 { x := (); total := (total x .+); } .for);
+        (10 { total := (total 2 .*); } .times);
+        (1..100 { if (.dup 7 .>) { (.break); } else { (.drop); }; } .for);
+        i := 0;
+        while (i 200 .<) .{
+            total := (total i .+ 1000003 .mod);
+            i := (i 1 .+);
+        };
+    """,
+    "blocks": """
+        square := { (.dup .*); };
+        twice := { f := (); (f .f); };
+        (3 .square);
+        (4 { (.square); } .twice);
+        (if (1 2 .<) { ("less" .println); } else { ("more" .println); });
+        same := square;
+        (square "squares a number" .set_help .drop);
+        (same .help .println);
+    """,
+    "strings": """
+        s := "";
+        i := 0;
+        while (i 300 .<) .{
+            s := (s "0123456789" .++);
+            i := (i 1 .+);
+        };
+        (s .len .println);
+        (s#5 .println);
+        ("," ["a" "b" "c"] .str_join .println);
+        (s 2 .* .len .println);
+        (3 (s "!" .++) .* .len .println);
+        ("examples/modules/" "./" 150 .* .++ "collatz" .++ .import);
+        (7 collatz::run .println $N);
+    """,
+    "bigint": """
+        n := 1;
+        (1..300 { n := (n .*); } .for);
+        (n n 7 .+ ./i);
+        (n 1000003 .mod);
+        (3 n 1000000007 .powmod);
+    """,
+    "callbacks": """
+        ([1] 0 { (.drop .drop); } .reduce $N);
+        f := { ([1] 0 { (.drop .drop); } .reduce $N); };
+        (.f);
+        g := { ([1 2] { (.drop .drop); } .map .collect); };
+        (.g .println);
+        h := { (10); };
+        ten := { (10); };
+        twenty := { (20); };
+        out := [];
+        flip := { if (h ten .=) .{ h := twenty; } else .{ h := ten; }; (.drop .drop 0); };
+        step := {
+            out := (out .h .swap .push);
+            ([1] 0 flip .reduce .drop);
+            out := (out .h .swap .push);
+        };
+        (3 { (.step); } .times);
+        (out .println);
+    """,
+    "streaming": """
+        (1..3 { ("m" .println); } .map { (.println); } .foreach);
+        (1..100000000 { (.drop); } .foreach);
+    """,
+    "locals": """
+        fact := { local n; n := (); if (n 1 .<) (1) else (n 1 .- .fact n .*); };
+        (12 .fact .println);
+        count := {
+            local i t;
+            i := 0;
+            t := 0;
+            while (i 300 .<) .{
+                t := (t i .+ 1000003 .mod);
+                i := (i 1 .+);
+            };
+            (t);
+        };
+        (.count .count .+ .println);
+        shadow := { local t; t := 5; (.{ local t; t := 7; (t); } t .+); };
+        (.shadow .println);
+        scale := { local k; k := (); ([1 2 3] { (k .*); } .pmap); };
+        (10 .scale .println);
+        broken := { local u; (u); };
+        (.broken);
+    """,
+    "local-memory": """
+        keep := { local big; big := (1..30000 .collect); (1..30000 .collect .len); };
+        (.keep .println);
+    """,
+    "collect-memory": """
+        (1..100000 { (1 .+); } .map .collect .len .println);
+    """,
+    "join-memory": """
+        (", " (1..100000 { (1 .+); } .map) .str_join .len .println);
+    """,
+    "stack-memory": """
+        while (1) .{ (7 7 7); };
+    """,
+    "sorting": """
+        xs := (1..200 { (7919 .* 1009 .mod); } .map .collect);
+        sorted := (xs .sort);
+        (sorted sorted#17 .bsearch .println);
+        (sorted 5000 .bsearch .println);
+        (xs { (10 .mod); } .sort_by 5 .take .collect .println);
+        (xs { (.dup .*); } .map .collect .uniq .len .println);
+        ([[1] 2 [1] "a" "a" $N] .uniq .println);
+        (xs .set 17 .contains);
+        (1..12 { (3 .mod); } .group_by .println);
+        (1..4 { ([(2 .mod)]); } .map .uniq .println);
+        k := { (1); };
+        one := { (1); };
+        two := { (2); };
+        keys := [];
+        flip := { if (k one .=) .{ k := two; } else .{ k := one; }; (.drop 0); };
+        step := {
+            keys := (keys .k .swap .push);
+            ([1] flip .sort_by .drop);
+            keys := (keys .k .swap .push);
+            ([1] flip .map .sort .drop);
+            keys := (keys .k .swap .push);
+        };
+        (3 { (.step); } .times);
+        (keys .println);
+        ([2 "b" 1] .sort);
+    """,
+    "parallel": """
+        square := { (.dup .*); };
+        ([1 2 3 4 5 6] square .pmap .sum .println);
+        ([1 2 3] { (.dup); } .pforeach);
+        ([1 2 3] { (2 .*); } .pmap .println);
+        ("examples/modules/collatz" .import);
+        (1..4 collatz#$run .pmap .println);
+        ([1 2 3 4] { (.dup .println 2 .*); } .pmap .println);
+        ([1 2 3] { (1..3 { (1 .+); } .map); } .pmap .len .println);
+    """,
+}
+
+
+def no_input():
+    raise EOFError("no input in conformance runs")
+
+def tutorial_snippets():
+    """code blocks of the tutorial that aren't console sessions"""
+    snippets = {}
+    for path in sorted(glob.glob(os.path.join(ROOT, "tutorial", "*.md"))):
+        with open(path) as file:
+            text = file.read()
+        name = os.path.basename(path)
+        for i, block in enumerate(re.findall(r"```\n(.*?)```", text, re.S)):
+            if "[stekk" in block:
+                continue
+            snippets[f"{name}#{i}"] = block
+    return snippets
+
+def examples():
+    programs = {}
+    for path in sorted(glob.glob(os.path.join(ROOT, "examples", "*.stekk"))
+                       + glob.glob(os.path.join(ROOT, "examples", "*", "*.stekk"))):
+        with open(path) as file:
+            programs[os.path.relpath(path, ROOT)] = file.read()
+    return programs
+
+
+VALUES = ["0", "1", "2", "3", "7", "-4", "12", '"ab"', '"xyz"', "[1 2 3]",
+          "[]", "$N", "a", "b", "c"]
+# no *, ++ or push inside loops and blocks, where they could grow values
+# exponentially
+OPERATORS = ["+", "-", "mod", "/i", "<", ">=", "=", "!=", "not", "and", "or",
+             "dup", "swap", "drop", "over", "rot", "len", "rev", "sum",
+             "contains", "last"]
+GROWING = ["*", "++", "push"]
+
+def random_program(rng, statements=12):
+    """a terminating program, most of whose statements do something"""
+    counters = iter(range(1000))
+
+    def tokens(nested):
+        operators = OPERATORS if nested else OPERATORS + GROWING
+        items = []
+        for _ in range(rng.randint(1, 5)):
+            if rng.random() < 0.55:
+                items.append(rng.choice(VALUES))
+            else:
+                items.append("." + rng.choice(operators))
+        return " ".join(items)
+
+    def statement(depth):
+        kind = rng.choice(["assign", "stack", "print", "block", "call",
+                           "while", "if", "times", "for"] if depth < 2
+                          else ["assign", "stack", "print"])
+        nested = depth > 0
+        if kind == "assign":
+            return f"{rng.choice('abc')} := ({tokens(nested)})"
+        if kind == "stack":
+            return f"({tokens(nested)})"
+        if kind == "print":
+            return f"({tokens(nested)} .println)"
+        if kind == "block":
+            return f"f := {{ {statement(2)}; }}"
+        if kind == "call":
+            return f"({tokens(nested)} .f)"
+        if kind == "while":
+            i = f"i{next(counters)}"
+            return (f"{i} := 0; while ({i} {rng.randint(0, 4)} .<) .{{ "
+                    f"{statement(depth + 1)}; {i} := ({i} 1 .+); }}")
+        if kind == "if":
+            return (f"if ({tokens(nested)}) {{ {statement(depth + 1)}; }} "
+                    f"else {{ {statement(depth + 1)}; }}")
+        if kind == "times":
+            return f"({rng.randint(0, 4)} {{ {statement(2)}; }} .times)"
+        return f"(1..{rng.randint(0, 4)} {{ {statement(2)}; }} .for)"
+
+    lines = ['a := 1; b := "s"; c := [1 2]; f := { (.dup); };']
+    lines += [statement(0) + ";" for _ in range(statements)]
+    return "\n".join(lines)
+
+
+def fresh(statements):
+    """a copy of the statements that shares the constants"""
+    memo = {id(const): const for const in Const.const.values()}
+    return copy.deepcopy(statements, memo)
+
+def run(statements, options):
+    output = []
+    def printer(*values, end="\n"):
+        output.append(" ".join(map(str, values)) + end)
+
+    vm = VM(fresh(statements), printer=printer, reader=no_input,
+            operations_limit=OPERATIONS_LIMIT, **options)
+    captured = io.StringIO() # type errors are printed with print
+    error = None
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(captured):
+        try:
+            vm.run()
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+    elapsed = time.perf_counter() - start
+    result = {
+        "output": "".join(output),
+        "printed": captured.getvalue(),
+        "stack": [repr(x) for x in vm.stack],
+        "names": {name: repr(value) for name, value in vm.names.items()
+                  if vm_builtins.get(name) is not value},
+        "result": repr(vm.last_result),
+        "error": error,
+    }
+    return result, elapsed
+
+def differences(expected, actual):
+    # after an error too: the stack and the names are what they were
+    # when it was raised
+    return [key for key in expected if expected[key] != actual[key]]
+
+
+def run_served(source, results):
+    results.put(server.run_program(source, OPERATIONS_LIMIT))
+
+def served_differences(source, expected):
+    """
+    Run the source through the server's run_program, in a daemon
+    process like the server's workers, and compare what it printed
+    """
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=run_served, args=(source, results),
+                              daemon=True)
+    process.start()
+    served = results.get(timeout=60)
+    process.join()
+    return [key for key in ("output", "error")
+            if expected[key] != served[key]]
+
+
+def available_engines():
+    engines = {}
+    for name, options in ENGINES.items():
+        if "arithmetic" in options:
+            try:
+                get_arithmetic(options["arithmetic"])
+            except ImportError:
+                continue
+        engines[name] = options
+    return engines
+
+def calibration():
+    """seconds taken by a fixed amount of plain Python work"""
+    best = None
+    for _ in range(10):
+        start = time.perf_counter()
+        total = 0
+        for i in range(300_000):
+            total += i % 7
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def parse_args(args):
+    options = {"random": 200, "seed": 0, "repeat": 3, "threshold": 0.3,
+               "update-baseline": False, "verbose": False}
+    for arg in args:
+        key, _, value = arg.lstrip("-").partition("=")
+        if key not in options:
+            print("unknown option:", arg)
+            exit(2)
+        default = options[key]
+        options[key] = (True if isinstance(default, bool)
+                        else type(default)(value))
+    return options
+
+def main():
+    options = parse_args(sys.argv[1:])
+    os.chdir(ROOT) # examples import modules by relative path
+
+    rng = random.Random(options["seed"])
+    sources = {**examples(), **tutorial_snippets(), **PROGRAMS}
+    for i in range(options["random"]):
+        sources[f"random#{i}"] = random_program(rng)
+
+    corpus = {}
+    for name, source in sources.items():
+        try:
+            corpus[name] = parse(source)
+        except StekkSyntaxError:
+            if name.startswith("random#") or name in PROGRAMS:
+                print(f"{name}: doesn't parse")
+                exit(2)
+
+    engines = available_engines()
+    reference, *others = engines
+    unit = calibration()
+    timings = {engine: 0.0 for engine in engines}
+    failed = False
+    for name, statements in corpus.items():
+        expected = None
+        if name in SERVED:
+            keys = served_differences(sources[name], run(statements, {})[0])
+            if keys:
+                failed = True
+                print(f"{name}: the server differs from {reference} in "
+                      + ", ".join(keys))
+        if name in OVER_LIMIT:
+            limited, _ = run(statements, {"memory_limit": OVER_LIMIT[name]})
+            if not (limited["error"] or "").startswith("MemoryLimitExceeded"):
+                failed = True
+                print(f"{name}: doesn't stop at the memory limit")
+        for engine, engine_options in engines.items():
+            best = None
+            for _ in range(options["repeat"]):
+                result, elapsed = run(statements, engine_options)
+                best = elapsed if best is None else min(best, elapsed)
+            timings[engine] += best
+            if expected is None:
+                expected = result
+                continue
+            keys = differences(expected, result)
+            if keys:
+                failed = True
+                print(f"{name}: {engine} differs from {reference} in "
+                      + ", ".join(keys))
+                if options["verbose"]:
+                    for key in keys:
+                        print(f"    {reference}: {expected[key]!r}")
+                        print(f"    {engine}: {result[key]!r}")
+
+    # the machine may have been busy at one of the two
+    unit = min(unit, calibration())
+    # the timings are totals, so only a run over the same corpus compares
+    digest = hashlib.sha256(json.dumps(sources, sort_keys=True).encode())
+    corpus_key = (f"random={options['random']} seed={options['seed']} "
+                  f"sources={digest.hexdigest()[:16]}")
+    relative = {engine: seconds / (unit if engine == reference
+                                   else timings[reference])
+                for engine, seconds in timings.items()}
+    try:
+        with open(BASELINE_PATH) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        baseline = {}
+    if baseline.get("corpus") != corpus_key:
+        baseline = {"corpus": corpus_key, "engines": {}}
+    recorded = baseline["engines"]
+
+    print(f"{len(corpus)} programs, {len(engines)} engines")
+    for engine, seconds in timings.items():
+        line = f"{engine:14} {seconds * 1000:9.1f} ms  {relative[engine]:8.2f}"
+        if engine in recorded:
+            change = relative[engine] / recorded[engine] - 1
+            line += f"  {change:+7.1%}"
+            if change > options["threshold"]:
+                line += "  slower than the baseline"
+                failed = True
+        print(line)
+    if not recorded:
+        print(f"no baseline for {corpus_key}")
+
+    if options["update-baseline"]:
+        recorded.update(relative)
+        with open(BASELINE_PATH, "w") as file:
+            json.dump(baseline, file, indent=4, sort_keys=True)
+            file.write("\n")
+        print("baseline updated")
+        failed = False
+    exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
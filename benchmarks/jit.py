@@ -0,0 +1,39 @@
+# compares the interpreter with the tiering compiler on a tight loop
+#
+# usage: python benchmarks/jit.py
+
+import os
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+sys.path.insert(0, os.path.join(here, ".."))
+
+from stekk.parser import parse
+from stekk.vm import VM
+
+PROGRAM = """
+square := { (.dup .*) };
+i := 0;
+total := 0;
+while (i 20000 .<) .{
+    total := (total i .square .+ 1000007 .mod);
+    i := (i 1 .+);
+};
+"""
+
+def timed(**kwargs):
+    vm = VM(parse(PROGRAM), operations_limit=10**9, **kwargs)
+    start = time.perf_counter()
+    vm.run()
+    return time.perf_counter() - start, vm.names["total"]
+
+def main():
+    interpreted, expected = timed()
+    compiled, result = timed(jit_threshold=10)
+    assert result == expected
+    print(f"interpreter   {interpreted * 1000:8.1f} ms")
+    print(f"jit           {compiled * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# compares restoring a VM snapshot with re-running the code that built it
+#
+# usage: python benchmarks/snapshot.py
+
+import os
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+sys.path.insert(0, os.path.join(here, ".."))
+
+from stekk.parser import parse
+from stekk.vm import VM
+
+SETUP = """
+squares := [];
+i := 0;
+while (i 2000 .<) .{
+    squares := (i i .* squares .push);
+    i := (i 1 .+);
+};
+double := { (2 .*) };
+table := [squares squares];
+"""
+
+def best_of(func, runs=5):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def rerun():
+    vm = VM(parse(SETUP), operations_limit=10**8)
+    vm.run()
+    return vm
+
+def main():
+    data = rerun().snapshot()
+    setup = best_of(rerun) * 1000
+    restore = best_of(lambda: VM.restore(data)) * 1000
+    print(f"snapshot size       {len(data):>10} bytes")
+    print(f"re-run setup code   {setup:10.2f} ms")
+    print(f"restore snapshot    {restore:10.2f} ms")
+
+if __name__ == "__main__":
+    main()
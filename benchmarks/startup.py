@@ -0,0 +1,39 @@
+# measures how long `python -m stekk` takes to start and run a tiny file
+#
+# usage: python benchmarks/startup.py [runs]
+
+import os
+import subprocess
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+root = os.path.join(here, "..")
+hello_world = os.path.join(root, "examples", "hello_world.stekk")
+
+COMMANDS = [
+    ("python -c pass", [sys.executable, "-c", "pass"]),
+    ("import stekk", [sys.executable, "-c", "import stekk"]),
+    ("python -m stekk hello_world", [sys.executable, "-m", "stekk", hello_world]),
+]
+
+def timeit(command, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=root, check=True,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for title, command in COMMANDS:
+        timeit(command, 1) # warm up the OS caches
+        timings = timeit(command, runs)
+        best = min(timings) * 1000
+        mean = sum(timings) / len(timings) * 1000
+        print(f"{title:<30} best {best:7.1f} ms   mean {mean:7.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+# builds a report a row at a time with ++; with ropes the time should
+# grow linearly with the number of rows, not quadratically
+#
+# usage: python benchmarks/strings.py
+
+import os
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+sys.path.insert(0, os.path.join(here, ".."))
+
+from stekk.parser import parse
+from stekk.vm import VM
+
+PROGRAM = """
+report := "";
+i := 0;
+while (i {rows} .<) .{{
+    report := (report "2024-01-01,widget,17,4.50\\n" .++);
+    i := (i 1 .+);
+}};
+(report .println);
+"""
+
+def timed(rows):
+    vm = VM(parse(PROGRAM.format(rows=rows)), operations_limit=10**9,
+            printer=lambda *values, end="\n": None)
+    start = time.perf_counter()
+    vm.run()
+    return time.perf_counter() - start
+
+def main():
+    for rows in (10_000, 20_000, 40_000, 80_000):
+        print(f"{rows:6} rows  {timed(rows) * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
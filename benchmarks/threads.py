@@ -0,0 +1,55 @@
+# runs many VMs on one parsed program in a thread pool; on a
+# free-threaded Python (3.13t and later) the throughput should grow
+# with the number of threads, up to the number of cores, and every VM
+# must still get the same result
+#
+# usage: python benchmarks/threads.py [VMS]
+
+import concurrent.futures
+import os
+import sys
+import time
+
+here, _ = os.path.split(__file__)
+sys.path.insert(0, os.path.join(here, ".."))
+
+from stekk.parser import parse
+from stekk.vm import VM
+
+PROGRAM = """
+square := { (.dup .*); };
+total := 0;
+(1..2000 { total := (total .swap .square .+ 1000007 .mod); } .for);
+i := 0;
+while (i 500 .<) .{
+    total := (total i .+ 1000007 .mod);
+    i := (i 1 .+);
+};
+"""
+
+def run(statements):
+    vm = VM(statements, operations_limit=10**9)
+    vm.run()
+    return vm.names["total"]
+
+def timed(statements, threads, vms):
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(run, [statements] * vms))
+        elapsed = time.perf_counter() - start
+    return elapsed, set(results)
+
+def main():
+    vms = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    statements = parse(PROGRAM) # shared by all the VMs
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"{os.cpu_count()} cores, GIL {'enabled' if gil else 'disabled'}")
+
+    expected = {run(statements)}
+    for threads in (1, 2, 4, 8, 16):
+        elapsed, results = timed(statements, threads, vms)
+        assert results == expected, results
+        print(f"{threads:3} threads  {vms / elapsed:8.1f} VMs/s")
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,12 @@ __all__ = ['loads', 'loadf', 'console']
 
 version = "0.0.1"
 
-import lark
 from .vm import VM
-from .interactive import console
+
+def console(vm=None):
+    # imported here so that running a file doesn't pay for click
+    from .interactive import console
+    return console(vm)
 
 def loads(string):
     error = False 
@@ -1,23 +1,155 @@
-from . import loadf
-from .interactive import console
-from .parser import StekkSyntaxError, parse
-from .vm import VM
+from . import loadf, console
+from .parser import StekkSyntaxError, has_comments, parse, write_program
+from .vm import VM, vm_builtins
+from .stack_effect import check_program, EffectCache, Unknown
+from .arithmetic import BACKENDS
+from .memory import MemoryLimitExceeded
+from .stats import FORMATS
+import io
 import sys
+import time
+
+def load_statements(filename):
+    try:
+        return loadf(filename).statements
+    except FileNotFoundError:
+        print("File not found:", filename)
+        exit(1)
+    except StekkSyntaxError as e:
+        print(e.error)
+        exit(2)
+
+def check(filenames):
+    """report pops from an empty stack and the effects of named blocks"""
+    found_errors = False
+    for filename in filenames:
+        statements = load_statements(filename)
+        diagnostics, bindings = check_program(statements, vm_builtins)
+        for index, message in diagnostics:
+            print(f"{filename}: statement {index + 1}: {message}")
+            if "empty stack" in message:
+                found_errors = True
+
+        names = {**vm_builtins, **bindings}
+        effects = EffectCache()
+        for name, block in bindings.items():
+            if block is None:
+                continue
+            try:
+                effect = effects.lookup(block, names)
+            except Unknown as e:
+                print(f"{filename}: {name}: unknown ({e})")
+            else:
+                print(f"{filename}: {name}: {effect}")
+    exit(1 if found_errors else 0)
+
+def fmt(args):
+    """
+    python -m stekk fmt [--check] [--write] FILE...
+
+    print the files formatted; comments are dropped
+    --check  also make sure the output parses back into the same program
+    --write  replace the files instead, but refuse files with comments,
+             which formatting would lose
+    """
+    options = [arg for arg in args if arg.startswith("--")]
+    filenames = [arg for arg in args if not arg.startswith("--")]
+    if set(options) - {"--check", "--write"} or not filenames:
+        print(fmt.__doc__)
+        exit(1)
+
+    found_errors = False
+    for filename in filenames:
+        out = io.StringIO()
+        write_program(load_statements(filename), out)
+        formatted = out.getvalue()
+        if "--check" in options:
+            again = io.StringIO()
+            try:
+                write_program(parse(formatted), again)
+            except StekkSyntaxError as e:
+                again.write(str(e.error))
+            if again.getvalue() != formatted:
+                print(f"{filename}: formatted source doesn't round-trip")
+                found_errors = True
+                continue
+        if "--write" in options:
+            with open(filename) as file:
+                if has_comments(file.read()):
+                    print(f"{filename}: not written, formatting would "
+                          "drop its comments")
+                    found_errors = True
+                    continue
+            with open(filename, "w") as file:
+                file.write(formatted)
+        else:
+            sys.stdout.write(formatted)
+    exit(1 if found_errors else 0)
+
+def vm_options(args):
+    """
+    --jit[=N]     compile code blocks and loops after N runs (default 100)
+    --jit-dump    print the generated Python source to stderr
+    --workers=N   processes for pmap and pforeach (default: one per CPU)
+    --chunk-size=N  items sent to a worker at a time
+    --arithmetic=B  python, gmpy2, or auto for gmpy2 if it's installed
+    --memory-limit=MB  stop with MemoryLimitExceeded above about MB megabytes
+    --stats=FILE  write run statistics to FILE when the program ends
+    --stats-format=F  json (default) or prometheus
+    """
+    options = {}
+    for arg in args:
+        if arg == "--jit":
+            options["jit_threshold"] = 100
+        elif arg.startswith("--jit="):
+            options["jit_threshold"] = int(arg[len("--jit="):])
+        elif arg == "--jit-dump":
+            options["jit_dump"] = True
+            options.setdefault("jit_threshold", 100)
+        elif arg.startswith("--workers="):
+            options["workers"] = int(arg[len("--workers="):])
+        elif (arg.startswith("--arithmetic=")
+              and arg[len("--arithmetic="):] in (*BACKENDS, "auto")):
+            options["arithmetic"] = arg[len("--arithmetic="):]
+        elif arg.startswith("--chunk-size="):
+            options["chunk_size"] = int(arg[len("--chunk-size="):])
+        elif arg.startswith("--memory-limit="):
+            options["memory_limit"] = int(arg[len("--memory-limit="):]) << 20
+        elif arg.startswith("--stats="):
+            options["stats_file"] = arg[len("--stats="):]
+        elif (arg.startswith("--stats-format=")
+              and arg[len("--stats-format="):] in FORMATS):
+            options["stats_format"] = arg[len("--stats-format="):]
+        else:
+            print("Unknown option:", arg)
+            print(vm_options.__doc__)
+            exit(1)
+    return options
 
 if len(sys.argv) == 1:
     console()
+elif sys.argv[1] == "check":
+    check(sys.argv[2:])
+elif sys.argv[1] == "fmt":
+    fmt(sys.argv[2:])
+elif sys.argv[1] == "compile-grammar":
+    from .parser import write_compiled_grammar
+    write_compiled_grammar()
+elif sys.argv[1] == "serve":
+    from .server import main
+    main(sys.argv[2:])
 elif len(sys.argv) > 1:
-    filenames = sys.argv[1:]
-    vm = VM([])
+    options = vm_options(arg for arg in sys.argv[1:] if arg.startswith("--"))
+    filenames = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    vm = VM([], **options)
     for filename in filenames:
-        try:
-            statements = loadf(filename).statements
-            vm.statements.extend(statements)
-        except FileNotFoundError:
-            print("File not found:", filename)
-            exit(1)
-        except StekkSyntaxError as e:
-            print(e.error)
-            exit(2)
-    vm.run()
-    console(vm)
\ No newline at end of file
+        start = time.perf_counter()
+        vm.statements.extend(load_statements(filename))
+        vm.stats.parse_time += time.perf_counter() - start
+    try:
+        vm.run()
+    except MemoryLimitExceeded as e:
+        print(e)
+        exit(3)
+    if sys.stdin.isatty():
+        console(vm)
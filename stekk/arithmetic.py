@@ -0,0 +1,85 @@
+# The numeric built-ins that get slow on big integers go through an
+# arithmetic backend, chosen when a VM is made. Backends take and return
+# plain ints, so the rest of the interpreter never sees another type.
+
+import operator
+
+
+class PythonArithmetic:
+    """CPython's own integers"""
+    name = "python"
+    # built-ins that compiled code must call instead of inlining
+    routed = frozenset()
+
+    mul = staticmethod(operator.mul)
+    floordiv = staticmethod(operator.floordiv)
+    mod = staticmethod(operator.mod)
+    powmod = staticmethod(pow)
+
+
+class GmpArithmetic:
+    """
+    Hands big integers to GMP through gmpy2. Converting to mpz and back
+    takes linear time, so it's only done above the operand sizes where
+    GMP's multiplication and division win it back (see
+    benchmarks/bigint.py); smaller numbers stay in Python.
+    """
+    name = "gmpy2"
+    routed = frozenset({"*", "mod", "/i", "powmod"})
+
+    # in bits
+    MUL_THRESHOLD = 2560
+    DIV_THRESHOLD = 1024
+    POWMOD_THRESHOLD = 16
+
+    def __init__(self):
+        import gmpy2
+        self.mpz = gmpy2.mpz
+        self.gmp_powmod = gmpy2.powmod
+
+    def mul(self, a, b):
+        if (type(a) is int and type(b) is int
+                and a.bit_length() > self.MUL_THRESHOLD
+                and b.bit_length() > self.MUL_THRESHOLD):
+            return int(self.mpz(a) * self.mpz(b))
+        return a * b
+
+    def floordiv(self, a, b):
+        if (type(a) is int and type(b) is int
+                and b.bit_length() > self.DIV_THRESHOLD):
+            return int(self.mpz(a) // self.mpz(b))
+        return a // b
+
+    def mod(self, a, b):
+        if (type(a) is int and type(b) is int
+                and b.bit_length() > self.DIV_THRESHOLD):
+            return int(self.mpz(a) % self.mpz(b))
+        return a % b
+
+    def powmod(self, base, exponent, modulus):
+        if (type(base) is int and type(exponent) is int
+                and type(modulus) is int and exponent >= 0 and modulus != 0
+                and modulus.bit_length() > self.POWMOD_THRESHOLD):
+            # Python's result takes the sign of the modulus
+            return int(self.gmp_powmod(base, exponent, modulus)) % modulus
+        return pow(base, exponent, modulus)
+
+
+BACKENDS = {
+    "python": PythonArithmetic,
+    "gmpy2": GmpArithmetic,
+}
+
+def get_arithmetic(name):
+    """
+    "python", "gmpy2", or "auto" for gmpy2 when it's installed.
+    Raises ImportError for "gmpy2" without gmpy2.
+    """
+    if name == "auto":
+        try:
+            return GmpArithmetic()
+        except ImportError:
+            return PythonArithmetic()
+    if name not in BACKENDS:
+        raise ValueError(f"unknown arithmetic backend: {name}")
+    return BACKENDS[name]()
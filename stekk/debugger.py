@@ -0,0 +1,117 @@
+# A VM doesn't check for breakpoints anywhere. Attaching a debugger
+# shadows the VM's execute_statements and call with versions
+# that stop before statements, and detaching removes them again, so a
+# VM without a debugger runs exactly the code it would run otherwise.
+
+from .parser import Expr, Stmt, CodeBlock, LocalBlock
+
+STEP = "step"
+NEXT = "next"
+CONTINUE = "continue"
+
+
+class Debugger:
+    """
+    `pause(debugger, stmt)` is called whenever execution stops before
+    a statement, and returns how to go on: STEP stops at the next
+    statement, NEXT at the next one that isn't inside a called block,
+    CONTINUE at the next breakpoint.
+
+    Breakpoints are either source lines (of whatever program or block
+    is running) or names: a name stops at the first statement of the
+    code block bound to it whenever that block is called.
+    """
+    def __init__(self, pause):
+        self.pause = pause
+        self.vm = None
+        self.jit = None
+        self.lines = set()
+        self.names = set()
+        self.mode = CONTINUE
+        self.next_depth = 0
+        self.frames = [] # code blocks being run, innermost last
+
+    @property
+    def attached(self):
+        return self.vm is not None
+
+    def attach(self, vm):
+        self.vm = vm
+        # compiled code runs whole blocks and loops without statements
+        self.jit, vm.jit = vm.jit, None
+        vm.execute_statements = self.execute_statements
+        vm.call = self.call
+
+    def detach(self):
+        vm = self.vm
+        del vm.execute_statements
+        del vm.call
+        if self.jit is not None:
+            # names may have been reassigned without telling the old one
+            vm.jit = type(self.jit)(vm, self.jit.threshold, self.jit.dump)
+        self.vm = self.jit = None
+        self.frames = []
+        self.mode = CONTINUE
+
+    def add_breakpoint(self, where):
+        if isinstance(where, int):
+            self.lines.add(where)
+        else:
+            self.names.add(where)
+
+    def remove_breakpoint(self, where):
+        self.lines.discard(where)
+        self.names.discard(where)
+
+    def names_of(self, value):
+        return [name for name, bound in self.vm.names.items()
+                if bound is value]
+
+    def before(self, stmt):
+        if (self.mode == STEP
+                or (self.mode == NEXT and len(self.frames) <= self.next_depth)
+                or (stmt.line in self.lines if isinstance(stmt, Stmt)
+                    else False)):
+            self.mode = self.pause(self, stmt)
+            self.next_depth = len(self.frames)
+
+    def execute_statements(self, statements):
+        vm = self.vm
+        try:
+            for stmt in statements:
+                self.before(stmt)
+                vm.register_operation()
+                if isinstance(stmt, (Expr, Stmt)):
+                    vm.last_result = stmt.run(vm)
+                else:
+                    vm.last_result = stmt
+        finally:
+            self.frames = []
+            self.mode = CONTINUE
+
+    def call(self, func):
+        vm = self.vm
+        if not isinstance(func, CodeBlock):
+            return func(vm)
+
+        if self.mode != STEP and any(vm.names.get(name) is func
+                                     for name in self.names):
+            self.mode = STEP
+        self.frames.append(func)
+        vm.call_depth += 1
+        if vm.call_depth > vm.call_depth_peak:
+            vm.call_depth_peak = vm.call_depth
+        local = isinstance(func, LocalBlock)
+        if local:
+            vm.local_frames.append(func.new_frame())
+        try:
+            result = None
+            for stmt in func.stmts:
+                self.before(stmt)
+                result = stmt.run(vm)
+            return result
+        finally:
+            self.frames.pop()
+            vm.call_depth -= 1
+            if local:
+                vm.local_frames.pop()
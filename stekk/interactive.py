@@ -5,6 +5,7 @@ import re
 import lark
 import stekk
 import click
+from .debugger import Debugger, STEP, NEXT, CONTINUE
 
 import os
 here, _ = os.path.split(__file__)
@@ -14,27 +15,186 @@ function_t = type(lambda: ...)
 UP_ARROW = "\x1b[A"
 DOWN_ARROW = "\x1b[B"
 
-with open(os.path.join(here, "interactive/ascii_art"), "r") as file:
-    ascii_art = file.read()
+def load_ascii_art():
+    with open(os.path.join(here, "interactive/ascii_art"), "r") as file:
+        return file.read()
 
 pre_string = f"[stekk v{stekk.version}]"
 
 def is_name_char(char):
     return bool(re.match(r"[a-zA-Z0-9<>+\-*\/~\^&|%?_'=!]", char))
 
+class BracketBalance:
+    """
+    Follows bracket nesting across continuation lines, so the console
+    can tell that the input is unfinished without parsing all of it
+    again after every line
+    """
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, line):
+        i = 0
+        while i < len(line):
+            char = line[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif line.startswith(";;", i): # comment until end of line
+                break
+            elif char in "([{":
+                self.depth += 1
+            elif char in ")]}":
+                self.depth -= 1
+            i += 1
+
+    @property
+    def unfinished(self):
+        # too many closing brackets is an error, not unfinished input
+        return self.in_string or self.depth > 0
+
+
 def backspace(width):
     click.echo("\b"*width, nl=False)
     click.echo(" "*width, nl=False)                     
     click.echo("\b"*width, nl=False)
 
 
+DEBUG_HELP = """\
+:break LINE|NAME    stop at a line, or when the block bound to NAME is called
+:clear [LINE|NAME]  remove a breakpoint, or all of them
+:breakpoints        list breakpoints
+:step               step through the next input
+:load FILE          run a file, its lines can have breakpoints
+when stopped: step (s), next (n), continue (c), stack, names [PREFIX],
+print NAME (p), where (w), break, clear"""
+
+def breakpoint_spec(arg):
+    return int(arg) if arg.isdigit() else arg
+
+def show_statement(stmt):
+    text = repr(stmt)
+    if len(text) > 60:
+        text = text[:57] + "..."
+    line = getattr(stmt, "line", None)
+    return text if line is None else f"line {line}: {text}"
+
+def breakpoint_command(debugger, word, arg):
+    """returns whether the command was a breakpoint command"""
+    if word == "break" and arg:
+        debugger.add_breakpoint(breakpoint_spec(arg))
+    elif word == "clear" and arg:
+        debugger.remove_breakpoint(breakpoint_spec(arg))
+    elif word == "clear":
+        debugger.lines.clear()
+        debugger.names.clear()
+    elif word == "breakpoints":
+        for where in sorted(debugger.lines) + sorted(debugger.names):
+            click.echo(where)
+    else:
+        return False
+    return True
+
+def debug_pause(debugger, stmt):
+    vm = debugger.vm
+    click.secho(f"stopped at {show_statement(stmt)}", fg="yellow")
+    while True:
+        try:
+            command = input("(debug) ").strip()
+        except EOFError:
+            click.echo("")
+            return CONTINUE
+        word, _, arg = command.partition(" ")
+        arg = arg.strip()
+
+        if word in ("", "s", "step"):
+            return STEP
+        elif word in ("n", "next"):
+            return NEXT
+        elif word in ("c", "continue"):
+            return CONTINUE
+        elif word == "stack":
+            click.echo(repr(vm.stack))
+        elif word == "names":
+            for name in vm.names_with_prefix(arg):
+                value = vm.names[name]
+                if stekk.vm.vm_builtins.get(name) is not value:
+                    click.echo(f"{name} = {value!r}")
+        elif word in ("p", "print"):
+            if arg in vm.names:
+                click.echo(repr(vm.names[arg]))
+            else:
+                click.secho(f"{arg} is not defined", fg="bright_red")
+        elif word in ("w", "where"):
+            for block in debugger.frames:
+                names = debugger.names_of(block)
+                click.echo("  in " + (", ".join(names) or "{...}"))
+            click.echo("  at " + show_statement(stmt))
+        elif not breakpoint_command(debugger, word, arg):
+            click.echo(DEBUG_HELP)
+
+def debugger_command(debugger, vm, command):
+    """handle a :command, returns statements to run if there are any"""
+    word, _, arg = command.partition(" ")
+    arg = arg.strip()
+    statements = None
+
+    if breakpoint_command(debugger, word, arg):
+        pass
+    elif word == "step":
+        if not debugger.attached:
+            debugger.attach(vm)
+        debugger.mode = STEP
+        return None
+    elif word == "load" and arg:
+        try:
+            with open(arg) as file:
+                statements = stekk.parser.parse(file.read())
+        except OSError as e:
+            click.secho(str(e), fg='bright_red')
+        except stekk.parser.StekkSyntaxError as e:
+            click.secho(str(e.error), fg='bright_red')
+    else:
+        click.echo(DEBUG_HELP)
+
+    if debugger.lines or debugger.names:
+        if not debugger.attached:
+            debugger.attach(vm)
+    elif debugger.attached and debugger.mode != STEP:
+        debugger.detach()
+    return statements
+
+def run_statements(vm, statements, debugger):
+    try:
+        vm.execute_statements(statements)
+        if vm.last_result is not None:
+            click.echo(vm.last_result) 
+        vm.last_result = None
+    except KeyboardInterrupt as e:
+        pass
+    except Exception as e:
+        click.secho(f"{e.__class__.__name__}: {e.args}", fg='bright_red')
+    if debugger.attached and not (debugger.lines or debugger.names):
+        debugger.detach() # back to the plain VM after :step
+
+
 def console(vm=None):
     if vm is None:
-        click.secho(ascii_art, fg='bright_green')
+        click.secho(load_ascii_art(), fg='bright_green')
         vm = stekk.vm.VM([])
 
     history = []
     total_command = ""
+    balance = BracketBalance()
+    debugger = Debugger(debug_pause)
 
     while True:
         if total_command == "":
@@ -84,8 +244,7 @@ def console(vm=None):
                     else:
                         while i > 0:
                             subs = command[-i:]
-                            possible = [name for name in vm.names
-                                        if name.startswith(subs)]
+                            possible = vm.names_with_prefix(subs)
                             if possible:
                                 break
                             i -= 1
@@ -145,20 +304,33 @@ def console(vm=None):
         except KeyboardInterrupt:
             click.echo("")
             total_command = ""
+            balance = BracketBalance()
             command = ""
         except EOFError:
             click.echo("")
             return
 
 
+        if total_command == "" and command.startswith(":"):
+            statements = debugger_command(debugger, vm, command[1:].strip())
+            if statements is not None:
+                run_statements(vm, statements, debugger)
+            continue
+
         if command.endswith("\\"):
             total_command += command[:-1] + "\n"
+            balance.feed(command[:-1] + "\n")
             continue
         else:
             total_command += command + "\n"
+            balance.feed(command + "\n")
+
+        if balance.unfinished:
+            continue
 
         command_to_run = total_command
         total_command = ""
+        balance = BracketBalance()
 
         try:
             statements = stekk.parser.parse(command_to_run)
@@ -167,12 +339,4 @@ def console(vm=None):
         except lark.exceptions.ParseError: # end of input
             total_command = command_to_run
         else:
-            try:
-                vm.execute_statements(statements)
-                if vm.last_result is not None:
-                    click.echo(vm.last_result) 
-                vm.last_result = None
-            except KeyboardInterrupt as e:
-                continue
-            except Exception as e:
-                click.secho(f"{e.__class__.__name__}: {e.args}", fg='bright_red')
+            run_statements(vm, statements, debugger)
@@ -0,0 +1,628 @@
+import sys
+
+from .parser import Stack, FcallExpr, CodeBlock, NameExpr, Const,\
+                    ListExpr, IfElseExpr, WhileExpr, StmtAssign, LvalueName,\
+                    StmtLocal, LocalBlock, LocalName, LvalueLocal, get_value
+
+# Tiering compiler. Code blocks and while loops that have run `threshold`
+# times are translated to Python source and compiled with compile().
+#
+# Each statement is compiled on its own. A statement made only of
+# literals, names, assignments, ifs, `()` stacks and calls of built-ins or
+# other such code blocks keeps its stack traffic in Python locals; any
+# other statement is handed to the interpreter. Operations are counted
+# exactly like the interpreter does: before each compiled statement the
+# most it can cost is checked against the limit, and if it could go over,
+# the rest of the block runs in the interpreter instead.
+#
+# When a built-in raises inside a compiled statement, values that the
+# statement had computed but not pushed yet are lost.
+
+none = Const.get("N")
+type_error = Const.get("T")
+NUMBER = (int, float)
+
+
+class Unsupported(Exception):
+    """the construct can't be compiled"""
+
+
+def resume_block(vm, stmts, start, result):
+    for i in range(start, len(stmts)):
+        result = stmts[i].run(vm)
+    return result
+
+def resume_while(vm, node, ret):
+    while get_value(node.condition, vm) == 1:
+        ret = get_value(node.body, vm)
+    return none if ret is None else ret
+
+def apply_kept(apply_onstack, vm, function, args, kept):
+    """
+    apply_onstack with the values that compiled code keeps in locals on
+    the stack while it runs, which is where the interpreter has them if
+    the built-in raises
+    """
+    stack = vm.stack
+    stack.extend(kept)
+    result = apply_onstack(vm, function, args)[0]
+    del stack[len(stack) - len(kept):]
+    return result
+
+def frame_slots(vm, scope):
+    """the slots of the latest running call of `scope`, or None"""
+    for block, slots in reversed(vm.local_frames):
+        if block is scope:
+            return slots
+    return None
+
+
+# built-ins that only move values around: they become renamings
+SHUFFLES = {
+    "dup": lambda a: [a, a],
+    "swap": lambda a, b: [b, a],
+    "drop": lambda a: [],
+    "over": lambda a, b: [a, b, a],
+    "rot": lambda a, b, c: [c, b, a],
+}
+
+# built-ins that raise ZeroDivisionError
+DIVISIONS = {"mod", "/f", "/i"}
+
+# built-ins with one result, written as an expression. {slow} is the
+# call of the real built-in, used when the arguments aren't plain numbers
+NUMBERS = "type({0}) in NUMBER and type({1}) in NUMBER"
+TEMPLATES = {
+    "+": "{0} + {1} if isinstance({0}, NUMBER) and isinstance({1}, NUMBER) else type_error",
+    "-": "{0} - {1} if isinstance({0}, NUMBER) and isinstance({1}, NUMBER) else type_error",
+    "*": "{0} * {1} if " + NUMBERS + " else {slow}",
+    "mod": "{0} % {1} if " + NUMBERS + " else {slow}",
+    "/f": "{0} / {1} if " + NUMBERS + " else {slow}",
+    "/i": "{0} // {1} if " + NUMBERS + " else {slow}",
+    "=": "int({0} == {1}) if " + NUMBERS + " else {slow}",
+    "!=": "int({0} != {1}) if " + NUMBERS + " else {slow}",
+    "<": "int({0} < {1}) if " + NUMBERS + " else {slow}",
+    ">": "int({0} > {1}) if " + NUMBERS + " else {slow}",
+    "<=": "int({0} <= {1}) if " + NUMBERS + " else {slow}",
+    ">=": "int({0} >= {1}) if " + NUMBERS + " else {slow}",
+    "not": "int(not {0})",
+    "and": "int({0} and {1}) if " + NUMBERS + " else {slow}",
+    "or": "int({0} or {1}) if " + NUMBERS + " else {slow}",
+}
+
+# what an expression evaluates to
+VALUE = "value"
+NOTHING = "nothing"
+MAYBE = "maybe"
+
+
+class Compiler:
+    def __init__(self, names, builtins, apply_onstack, routed=frozenset()):
+        self.names = names
+        self.builtins = builtins
+        self.routed = routed # built-ins the arithmetic backend takes over
+        self.namespace = {
+            "none": none,
+            "type_error": type_error,
+            "NUMBER": NUMBER,
+            "apply_onstack": apply_onstack,
+            "apply_kept": apply_kept,
+            "resume_block": resume_block,
+            "resume_while": resume_while,
+            "get_value": get_value,
+            "frame_slots": frame_slots,
+        }
+        self.lines = []
+        self.level = 1
+        self.temps = 0
+        self.calls = set()
+        self.assigns = set()
+        self.inlining = set()
+        self.compiled_statements = 0
+        self.scopes = {} # id of a LocalBlock -> (variable of its slots, block)
+        self.own_scope = None # the LocalBlock being compiled
+
+        # state of the statement being compiled
+        self.values = [] # values "pushed" but still kept in locals
+        self.pending = 0 # operations not added to `ops` yet
+        self.budget = 0  # the most operations the statement can take
+
+    def emit(self, line):
+        self.lines.append("    " * self.level + line)
+
+    def temp(self):
+        self.temps += 1
+        return f"t{self.temps}"
+
+    def constant(self, value):
+        name = f"k{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def literal(self, value):
+        if type(value) in (int, str):
+            return repr(value)
+        return self.constant(value)
+
+    def slots(self, scope):
+        """the variable holding the slots of the frame of `scope`"""
+        entry = self.scopes.get(id(scope))
+        if entry is None:
+            entry = self.scopes[id(scope)] = (f"l{len(self.scopes)}", scope)
+        return entry[0]
+
+    def count(self, operations):
+        self.pending += operations
+        self.budget += operations
+
+    def flush_ops(self):
+        if self.pending:
+            self.emit(f"ops += {self.pending}")
+            self.pending = 0
+
+    def flush(self):
+        """move the values kept in locals to the real stack"""
+        if len(self.values) == 1:
+            self.emit(f"stack.append({self.values[0]})")
+        elif self.values:
+            self.emit(f"stack.extend(({', '.join(self.values)},))")
+        self.values = []
+        self.flush_ops()
+
+    def spill(self):
+        """
+        code that leaves the values kept in locals on the real stack, for
+        the branch that raises: the interpreter would have them there
+        """
+        if not self.values:
+            return "pass"
+        return f"stack.extend(({', '.join(self.values)},))"
+
+    def push(self, code, kind):
+        if kind == VALUE:
+            self.values.append(code)
+            self.count(1)
+        elif kind == MAYBE:
+            self.flush()
+            self.emit(f"if {code} is not None:")
+            self.emit(f"    stack.append({code})")
+            self.emit(f"    ops += 1")
+            self.budget += 1
+
+    def pop(self):
+        if self.values:
+            return self.values.pop()
+        t = self.temp()
+        self.emit(f"{t} = stack.pop() if stack else none")
+        return t
+
+    ["Whole units"]
+
+    def static_statement(self, stmt, result):
+        """
+        Try to compile a statement, storing its value in `result`.
+        Returns the most operations it can take, or None when the
+        statement has to be interpreted.
+        """
+        saved = (len(self.lines), set(self.calls), set(self.assigns),
+                 self.level)
+        self.values = []
+        self.pending = 0
+        self.budget = 0
+        try:
+            code, kind = self.expr(stmt)
+            self.flush()
+            if result is not None:
+                self.emit(f"{result} = {code if kind != NOTHING else None}")
+        except Unsupported:
+            del self.lines[saved[0]:]
+            self.calls, self.assigns, self.level = saved[1:]
+            return None
+        self.compiled_statements += 1
+        return self.budget
+
+    def statements(self, stmts, resume):
+        """
+        Compile the statements of a block into the current function.
+        `resume(i)` gives the code that continues in the interpreter
+        from statement i, with `r` holding the last result.
+        """
+        node = self.constant(stmts)
+        self.emit("r = None")
+        for i, stmt in enumerate(stmts):
+            start = len(self.lines)
+            budget = self.static_statement(stmt, "r")
+            if budget is not None:
+                self.lines[start:start] = self.budget_check(budget, resume(i))
+            else:
+                self.emit("vm.operations += ops; ops = 0")
+                self.emit(f"r = {node}[{i}].run(vm)")
+                self.emit("if jit.version != version:")
+                self.emit(f"    {resume(i + 1)}")
+
+    def budget_check(self, budget, resume):
+        prefix = "    " * self.level
+        return [
+            f"{prefix}if vm.operations + ops + {budget} > limit:",
+            f"{prefix}    vm.operations += ops; ops = 0",
+            f"{prefix}    {resume}",
+        ]
+
+    def function(self, name, args, body):
+        header = [
+            f"def {name}({args}):",
+            "    stack = vm.stack",
+            "    names = vm.names",
+            "    bind = vm.bind_name",
+            "    limit = vm.operations_limit",
+            "    version = jit.version",
+            "    ops = 0",
+        ]
+        # the frames of the enclosing blocks don't change during a call,
+        # so they are looked up once; None when the block isn't running
+        for variable, scope in self.scopes.values():
+            if scope is not self.own_scope:
+                header.append(f"    {variable} = frame_slots(vm, "
+                              f"{self.constant(scope)})")
+        footer = [
+            "    finally:",
+            "        vm.operations += ops",
+        ]
+        if self.own_scope is not None:
+            variable = self.slots(self.own_scope)
+            header.append(f"    {variable} = [None] * "
+                          f"{len(self.own_scope.slots)}")
+            header.append(f"    vm.local_frames.append(("
+                          f"{self.constant(self.own_scope)}, {variable}))")
+            footer.append("        vm.local_frames.pop()")
+        header.append("    try:")
+        body = ["    " + line for line in body]
+        return "\n".join(header + body + footer) + "\n"
+
+    def block(self, block):
+        self.level = 1
+        if isinstance(block, LocalBlock):
+            self.own_scope = block
+        stmts = self.constant(block.stmts)
+        self.statements(block.stmts,
+                        lambda i: f"return resume_block(vm, {stmts}, {i}, r)")
+        self.emit("return r")
+        return self.function("compiled_block", "vm", self.lines)
+
+    def loop(self, node):
+        """a while loop, entered with the last body result in `ret`"""
+        this = self.constant(node)
+        self.level = 1
+        self.emit("while True:")
+        self.level = 2
+
+        start = len(self.lines)
+        budget = self.static_statement(node.condition, "c")
+        if budget is not None:
+            self.lines[start:start] = self.budget_check(
+                budget, f"return resume_while(vm, {this}, ret)")
+        else:
+            raise Unsupported("condition")
+        self.emit("if not (c == 1):")
+        self.emit("    break")
+
+        body = node.body
+        block = self.callee_block(body) if isinstance(body, FcallExpr) else None
+        if block is not None:
+            # call overhead of `.{...}` or `.name`, then the statements
+            cost = 1 + isinstance(body.func, NameExpr)
+            self.lines.extend(self.budget_check(
+                cost, f"ret = get_value({this}.body, vm); "
+                      f"return resume_while(vm, {this}, ret)"))
+            self.emit(f"ops += {cost}")
+            stmts = self.constant(block.stmts)
+            self.statements(
+                block.stmts,
+                lambda i: f"ret = resume_block(vm, {stmts}, {i}, r); "
+                          f"return resume_while(vm, {this}, ret)")
+            self.emit("ret = r")
+        else:
+            start = len(self.lines)
+            budget = self.static_statement(body, "ret")
+            if budget is None:
+                raise Unsupported("body")
+            self.lines[start:start] = self.budget_check(
+                budget, f"ret = get_value({this}.body, vm); "
+                        f"return resume_while(vm, {this}, ret)")
+
+        self.level = 1
+        self.emit("return none if ret is None else ret")
+        return self.function("compiled_loop", "vm, ret", self.lines)
+
+    ["Expressions"]
+
+    def callee_block(self, fcall):
+        func = fcall.func
+        if isinstance(func, LocalBlock):
+            return None # needs a frame of its own
+        if isinstance(func, CodeBlock):
+            return func
+        if isinstance(func, NameExpr):
+            value = self.names.get(func.name)
+            if isinstance(value, CodeBlock) and not isinstance(value, LocalBlock):
+                self.calls.add(func.name)
+                return value
+        return None
+
+    def expr(self, x):
+        """emit code for x, returns (code for its value, kind)"""
+        if isinstance(x, Stack):
+            for expr in x.exprs:
+                self.push(*self.expr(expr))
+            if self.values:
+                return self.values.pop(), VALUE
+            t = self.temp()
+            self.emit(f"{t} = stack.pop() if stack else None")
+            return t, MAYBE
+
+        elif isinstance(x, FcallExpr):
+            return self.fcall(x.func)
+
+        elif isinstance(x, StmtAssign):
+            if not isinstance(x.lvalue, (LvalueName, LvalueLocal)):
+                raise Unsupported(x)
+            code, kind = self.expr(x.expr)
+            if kind == NOTHING:
+                code = "none"
+            elif kind == MAYBE:
+                self.emit(f"if {code} is None: {code} = none")
+            self.count(1)
+            if isinstance(x.lvalue, LvalueLocal):
+                slots = self.slots(x.lvalue.scope)
+                scope = self.constant(x.lvalue.scope)
+                self.emit(f"if {slots} is None: "
+                          f"vm.assign_local({scope}, {x.lvalue.slot}, {code})")
+                self.emit(f"{slots}[{x.lvalue.slot}] = {code}")
+                return None, NOTHING
+            self.assigns.add(x.lvalue.name)
+            self.emit(f"bind({x.lvalue.name!r}, {code})")
+            return None, NOTHING
+
+        elif isinstance(x, LocalName):
+            self.count(1)
+            slots = self.slots(x.scope)
+            scope = self.constant(x.scope)
+            t = self.temp()
+            self.emit(f"{t} = {slots} and {slots}[{x.slot}]")
+            # unassigned, or the block isn't running: raise like vm does
+            self.emit(f"if {t} is None: {self.spill()}; "
+                      f"vm.get_local({scope}, {x.slot})")
+            return t, VALUE
+
+        elif isinstance(x, StmtLocal):
+            return None, NOTHING
+
+        elif isinstance(x, IfElseExpr):
+            return self.ifelse(x)
+
+        elif isinstance(x, NameExpr):
+            self.count(1)
+            t = self.temp()
+            self.emit(f"{t} = names.get({x.name!r})")
+            self.emit(f"if {t} is None: {self.spill()}; names[{x.name!r}]")
+            return t, VALUE
+
+        elif isinstance(x, ListExpr):
+            items = []
+            for expr in x.exprs:
+                code, kind = self.expr(expr)
+                items.append("None" if kind == NOTHING else code)
+            t = self.temp()
+            self.emit(f"{t} = [{', '.join(items)}]")
+            return t, VALUE
+
+        elif isinstance(x, (CodeBlock, Const)):
+            return self.constant(x), VALUE
+
+        elif type(x) in (int, float, str):
+            return self.literal(x), VALUE
+
+        else:
+            raise Unsupported(x)
+
+    def ifelse(self, x):
+        code, kind = self.expr(x.condition)
+        if kind == NOTHING:
+            code = "None"
+        self.flush()
+        result = self.temp()
+        budget = self.budget
+
+        kinds = []
+        budgets = []
+        for branch_keyword, branch in (("if", x.branch_then),
+                                       ("else", x.branch_else)):
+            self.emit(f"if {code}:" if branch_keyword == "if" else "else:")
+            self.level += 1
+            self.budget = 0
+            branch_code, branch_kind = self.expr(branch)
+            self.flush()
+            self.emit(f"{result} = "
+                      f"{branch_code if branch_kind != NOTHING else None}")
+            self.level -= 1
+            kinds.append(branch_kind)
+            budgets.append(self.budget)
+
+        self.budget = budget + max(budgets)
+        if kinds[0] == kinds[1]:
+            return result, kinds[0]
+        return result, MAYBE
+
+    def fcall(self, func_expr):
+        if isinstance(func_expr, NameExpr):
+            name = func_expr.name
+            if name not in self.names:
+                raise Unsupported(name)
+            func = self.names[name]
+            self.calls.add(name)
+            self.count(2) # looking up the name, calling
+        elif isinstance(func_expr, CodeBlock):
+            func = func_expr
+            self.count(1)
+        else:
+            raise Unsupported(func_expr)
+
+        if isinstance(func, LocalBlock):
+            raise Unsupported("inlined calls would share a frame")
+        if isinstance(func, CodeBlock):
+            if id(func) in self.inlining:
+                raise Unsupported("recursion")
+            self.inlining.add(id(func))
+            try:
+                code, kind = None, NOTHING
+                for stmt in func.stmts:
+                    code, kind = self.expr(stmt)
+                return code, kind
+            finally:
+                self.inlining.remove(id(func))
+
+        return self.builtin(func)
+
+    def builtin(self, func):
+        name = getattr(func, "name", None)
+        effect = getattr(func, "effect", None)
+        if (effect is None or not hasattr(func, "function")
+                or not getattr(func, "trustme", False)):
+            raise Unsupported(func)
+        if getattr(func, "runs_code", False):
+            # the blocks it runs may rebind names that the code after the
+            # call has inlined, only the interpreter checks for that
+            raise Unsupported(func)
+
+        args = [self.pop() for _ in range(effect.needs)][::-1]
+        self.count(1 + effect.needs)
+        outputs = effect.needs + effect.delta
+        original = self.builtins.get(name) is func
+
+        if original and name in SHUFFLES:
+            for value in SHUFFLES[name](*args):
+                self.push(value, VALUE)
+
+        elif original and name in TEMPLATES and name not in self.routed:
+            function = self.constant(func.function)
+            arguments = f"({''.join(a + ', ' for a in args)})"
+            if self.values:
+                slow = (f"apply_kept(apply_onstack, vm, {function}, "
+                        f"{arguments}, ({''.join(v + ', ' for v in self.values)}))")
+            else:
+                slow = f"apply_onstack(vm, {function}, {arguments})[0]"
+            if name in DIVISIONS and self.values:
+                self.emit(f"if {NUMBERS.format(*args)} and not {args[1]}: "
+                          f"{self.spill()}")
+            t = self.temp()
+            self.emit(f"{t} = " + TEMPLATES[name].format(*args, slow=slow))
+            self.push(t, VALUE)
+
+        else:
+            function = self.constant(func.function)
+            self.flush()
+            t = self.temp()
+            self.emit(f"{t} = apply_onstack(vm, {function}, "
+                      f"({''.join(a + ', ' for a in args)}))")
+            self.emit(f"if {t}:")
+            self.emit(f"    stack.extend({t})")
+            self.emit(f"    ops += len({t})")
+            self.budget += max(outputs, 1)
+
+        return None, NOTHING
+
+
+class Jit:
+    """
+    Counts how often code blocks and while loops run, and compiles the
+    ones that get hot. Compiled code is dropped when a name it calls is
+    reassigned.
+    """
+    def __init__(self, vm, threshold, dump=False):
+        from .vm import vm_builtins, apply_onstack
+        self.vm = vm
+        self.threshold = threshold
+        self.dump = dump
+        self.builtins = vm_builtins
+        self.apply_onstack = apply_onstack
+        self.version = 0
+        self.counts = {}
+        self.compiled = {}
+        self.depends = {}
+
+    def invalidate(self, name):
+        for key in self.depends.pop(name, ()):
+            self.compiled.pop(key, None)
+            self.counts.pop(key, None)
+        # also retry everything that couldn't be compiled before
+        for key in [k for k, (_, f) in self.compiled.items() if f is None]:
+            del self.compiled[key]
+            self.counts.pop(key, None)
+        self.version += 1
+
+    def is_hot(self, node):
+        key = id(node)
+        node_, count = self.counts.get(key, (node, 0))
+        if node_ is not node:
+            count = 0
+        count += 1
+        self.counts[key] = (node, count)
+        return count >= self.threshold
+
+    def lookup(self, node):
+        entry = self.compiled.get(id(node))
+        if entry is not None and entry[0] is node:
+            return True, entry[1]
+        return False, None
+
+    def compile(self, node):
+        compiler = Compiler(self.vm.names, self.builtins, self.apply_onstack,
+                            self.vm.arithmetic.routed)
+        try:
+            if isinstance(node, WhileExpr):
+                source = compiler.loop(node)
+                name = "compiled_loop"
+            else:
+                source = compiler.block(node)
+                name = "compiled_block"
+        except Unsupported:
+            source = None
+
+        if (source is None or compiler.compiled_statements == 0
+                or compiler.calls & compiler.assigns):
+            function = None
+        else:
+            if self.dump:
+                print(f"# compiled {node!r}\n{source}", file=sys.stderr)
+            namespace = {**compiler.namespace, "jit": self}
+            exec(compile(source, f"<stekk jit {name}>", "exec"), namespace)
+            function = namespace[name]
+            for called in compiler.calls:
+                self.depends.setdefault(called, set()).add(id(node))
+
+        self.compiled[id(node)] = (node, function)
+        return function
+
+    def compiled_block(self, block):
+        found, function = self.lookup(block)
+        if found:
+            return function
+        if self.is_hot(block):
+            return self.compile(block)
+        return None
+
+    def run_while(self, node):
+        vm = self.vm
+        found, function = self.lookup(node)
+        if function is not None:
+            return function(vm, none)
+
+        ret = none
+        while get_value(node.condition, vm) == 1:
+            ret = get_value(node.body, vm)
+            if not found and self.is_hot(node):
+                found = True
+                function = self.compile(node)
+                if function is not None:
+                    return function(vm, ret)
+        return none if ret is None else ret
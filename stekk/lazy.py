@@ -0,0 +1,18 @@
+class Lazy:
+    """
+    A sequence whose items are only made when something iterates over
+    it, one at a time, so a chain of map, filter and take over a long
+    range runs in constant memory and stops as soon as it has enough.
+    Every iteration starts over from the source, so a lazy sequence
+    can be used more than once, unless it reads a stream.
+    """
+    __slots__ = ("items", "kind")
+
+    def __init__(self, items, kind):
+        self.items = items # makes a new iterator each time
+        self.kind = kind
+
+    def __iter__(self):
+        return self.items()
+
+    __repr__ = lambda self: f"Lazy[{self.kind}]"
@@ -0,0 +1,129 @@
+# Memory use is estimated the way a garbage collector paces itself.
+# Built-ins that make containers report their size before making them,
+# and the VM reports what the stack has grown by every so many
+# operations, which only adds to a counter. Once the reported bytes add up to enough, compared to what
+# was measured last time, everything reachable from the stack, the
+# names and the local variables is walked and measured, which also notices the values that were
+# dropped. Measuring costs time linear in the live data, so it's paid
+# for by the allocations since the last walk.
+
+import itertools
+import sys
+
+from .parser import CodeBlock, Namespace
+from .rope import Rope
+
+# bytes to allocate before the first walk, and between walks of a
+# small heap, when there's no limit
+MIN_WALK = 1 << 25
+
+# the types of values that contain other values
+NESTED = {list, tuple, dict, set, Rope, CodeBlock, Namespace}
+
+
+class MemoryLimitExceeded(MemoryError):
+    def __init__(self, size, limit):
+        super().__init__(f"memory limit of {limit} bytes exceeded "
+                         f"(about {size} bytes in use)")
+        self.size = size
+        self.limit = limit
+
+
+def children(value):
+    if isinstance(value, dict):
+        return list(value.values())
+    if isinstance(value, Rope):
+        return [value.parts]
+    if isinstance(value, Namespace):
+        return [value.stmts, value.members]
+    if isinstance(value, CodeBlock):
+        return [value.stmts]
+    return value
+
+def deep_size(roots, seen):
+    """bytes taken by the values, skipping the ids in `seen` and adding to it"""
+    total = 0
+    todo = [roots]
+    while todo:
+        # lists can be long, so the items are handled by map and sets
+        # rather than one at a time
+        values = todo.pop()
+        by_id = dict(zip(map(id, values), values))
+        fresh = by_id.keys() - seen
+        seen.update(fresh)
+        values = list(map(by_id.__getitem__, fresh))
+        total += sum(map(sys.getsizeof, values))
+        todo.extend(map(children, itertools.compress(
+            values, map(NESTED.__contains__, map(type, values)))))
+    return total
+
+
+class MemoryMeter:
+    """
+    `allocated` counts the bytes reported since the last walk, so
+    `measured + allocated` is an upper bound of what's in use now, and
+    is never allowed to go over the limit without walking. The peaks are
+    the high-water marks of the walks, so a value that is made and
+    dropped between two walks doesn't show up in them.
+    """
+    def __init__(self, vm, limit=None):
+        self.vm = vm
+        self.limit = limit
+        self.measured = 0
+        self.stack = 0
+        self.names = 0
+        self.allocated = 0
+        self.peak = 0
+        self.stack_peak = 0
+        self.names_peak = 0
+        self.walks = 0
+        self.next_walk = self.walk_after()
+
+    def walk_after(self):
+        if self.limit is not None:
+            # walk once the upper bound could be over the limit, but
+            # don't walk all the time right below it
+            return max(self.limit - self.measured, self.limit // 16)
+        # walks only update the peaks then; walking is much slower than
+        # copying, so it's paid for by allocating several times the heap
+        return max(MIN_WALK, 8 * self.measured)
+
+    def walk(self, incoming=0, enforce=True):
+        """
+        `incoming` is the size of a value that has been or is about to
+        be made, but that can't be reached from the VM yet. Without
+        `enforce`, going over the limit is left to the next allocation.
+        """
+        vm = self.vm
+        seen = set()
+        self.stack = deep_size([vm.stack], seen)
+        self.names = deep_size([vm.names], seen)
+        # the slots of the running calls, the bottom frame has none
+        frames = [slots for _, slots in vm.local_frames[1:]]
+        self.measured = (self.stack + self.names
+                         + deep_size([frames, vm.last_result], seen))
+        self.allocated = 0
+        self.walks += 1
+        self.peak = max(self.peak, self.measured)
+        self.stack_peak = max(self.stack_peak, self.stack)
+        self.names_peak = max(self.names_peak, self.names)
+        self.next_walk = self.walk_after()
+        if (enforce and self.limit is not None
+                and self.measured + incoming > self.limit):
+            raise MemoryLimitExceeded(self.measured + incoming, self.limit)
+
+    def report(self):
+        """
+        measures, and returns the sizes and peaks in bytes; reporting
+        doesn't raise MemoryLimitExceeded, so it's safe after any error
+        """
+        self.walk(enforce=False)
+        return {
+            "stack": self.stack,
+            "names": self.names,
+            "total": self.measured,
+            "stack_peak": self.stack_peak,
+            "names_peak": self.names_peak,
+            "peak": self.peak,
+            "limit": self.limit,
+        }
@@ -0,0 +1,128 @@
+# pmap and pforeach run a function over the items of a list in forked
+# worker processes. The pool is forked for every call, so the workers
+# see the names as they are at the time of the call without anything
+# being sent to them; only the results, and what the workers printed,
+# are pickled on the way back. The parent replays the printing through
+# its own printer, in the order of the items.
+
+import os
+import threading
+
+from . import snapshot
+from .memory import deep_size
+
+# set in the parent right before forking, so the workers inherit it;
+# VMs in other threads wait for the lock to fork their own pool
+job = None
+job_lock = threading.Lock()
+# whether this process is a worker, whose own pmaps run in-process
+in_worker = False
+
+
+def worker_vm(vm, operations, printer):
+    """a VM with a copy of the names of `vm`, that may run `operations`"""
+    worker = type(vm)(
+        [], printer=printer, reader=vm.reader,
+        operations_limit=operations,
+        jit_threshold=None if vm.jit is None else vm.jit.threshold,
+        arithmetic=vm.arithmetic.name, memory_limit=vm.memory.limit)
+    worker.names = dict(vm.names)
+    worker.help_texts = dict(vm.help_texts)
+    # the function may use locals of the block that called pmap
+    worker.local_frames = list(vm.local_frames)
+    return worker
+
+def run_items(vm, function, items, operations, printer):
+    """
+    Call the function on every item, each time on a stack holding only
+    the item, in at most `operations`. Returns (what the call left on
+    the stack, what it returned) for each item, and the number of
+    operations it took.
+    """
+    worker = worker_vm(vm, operations, printer)
+    calls = []
+    for item in items:
+        worker.stack = [item]
+        result = worker.function_call(function)
+        calls.append((worker.stack, result))
+    return calls, worker.operations
+
+def run_chunk(bounds):
+    global in_worker
+    in_worker = True
+    vm, function, items, builtins = job
+    start, end = bounds
+    # the chunks run at the same time, so each one gets its share of
+    # the remaining operations, or together they could go over the limit
+    remaining = vm.operations_limit - vm.operations
+    operations = remaining * (end - start) // len(items)
+    printed = []
+    def printer(*values, **options):
+        printed.append((values, options))
+    calls, operations = run_items(vm, function, items[start:end], operations,
+                                  printer)
+    return snapshot.dump((calls, operations, printed), builtins)
+
+
+def chunk_bounds(length, workers, chunk_size):
+    if chunk_size is None:
+        # a few chunks per worker, so a slow chunk doesn't hold up the rest
+        chunk_size = max(1, -(-length // (workers * 4)))
+    return [(start, min(start + chunk_size, length))
+            for start in range(0, length, chunk_size)]
+
+def run_here(vm, function, items):
+    """run_parallel without the workers"""
+    calls, operations = run_items(vm, function, items,
+                                  vm.operations_limit - vm.operations,
+                                  vm.printer)
+    vm.register_operation(operations)
+    vm.allocate(deep_size([calls], set()))
+    return calls
+
+def run_parallel(vm, function, items, builtins):
+    """
+    Returns (what the call left on the stack, what it returned) for
+    each item, in the order of the items
+    """
+    import multiprocessing # only here, it takes a while to import
+    workers = vm.workers or os.cpu_count() or 1
+    # daemon processes, like the server's workers, can't have children
+    if (workers == 1 or len(items) < 2 or in_worker
+            or multiprocessing.current_process().daemon
+            or "fork" not in multiprocessing.get_all_start_methods()):
+        return run_here(vm, function, items)
+
+    try:
+        chunks = run_forked(vm, function, items, builtins, workers)
+    except snapshot.SnapshotError:
+        # a result the workers can't send back, like a lazy sequence:
+        # nothing they printed has been shown, so run it all here
+        return run_here(vm, function, items)
+
+    calls = []
+    operations = 0
+    for chunk_calls, chunk_operations, printed in chunks:
+        calls.extend(chunk_calls)
+        operations += chunk_operations
+        for values, options in printed:
+            vm.printer(*values, **options)
+    vm.register_operation(operations)
+    # the workers' meters only saw the values while they were made
+    vm.allocate(deep_size([calls], set()))
+    return calls
+
+def run_forked(vm, function, items, builtins, workers):
+    """what run_chunk gives for each chunk, loaded, in order"""
+    import multiprocessing
+    global job
+    with job_lock:
+        job = (vm, function, items, builtins)
+        try:
+            bounds = chunk_bounds(len(items), workers, vm.chunk_size)
+            context = multiprocessing.get_context("fork")
+            with context.Pool(min(workers, len(bounds))) as pool:
+                chunks = pool.map(run_chunk, bounds)
+        finally:
+            job = None
+    return [snapshot.load(data, builtins) for data in chunks]
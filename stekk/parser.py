@@ -1,6 +1,17 @@
+import hashlib
+import io
 import json
 import os
+import re
+import threading
 from lark import Lark, Transformer, v_args, UnexpectedInput
+from lark import __version__ as lark_version
+from lark.common import LexerConf
+from lark.grammar import Rule
+from lark.lark import LarkOptions
+from lark.lexer import TerminalDef
+
+from .rope import Rope
 
 def joinr(s, x):
     return s.join(map(repr, x))
@@ -8,13 +19,42 @@ def joinr(s, x):
 def joins(s, x):
     return s.join(map(str, x))
 
+def write_src(x, out, depth=0, indent="    "):
+    """
+    Write the source of a value to `out`, which only needs a write
+    method. Lines after the first are indented for `depth`, the first
+    one isn't, so that it can go after other code.
+    """
+    if isinstance(x, Stmt):
+        x.write_src(out, depth, indent)
+    elif isinstance(x, (str, Rope)):
+        out.write('"')
+        out.write(str(x))
+        out.write('"')
+    elif isinstance(x, list):
+        ListExpr(x).write_src(out, depth, indent)
+    else:
+        out.write(repr(x))
+
+def write_program(statements, out, indent="    "):
+    for stmt in statements:
+        write_src(stmt, out, 0, indent)
+        out.write(";\n")
+
+def has_comments(source):
+    """whether the source has ;; comments, which write_program can't keep"""
+    return ";;" in re.sub(r'"(?:[^"\\\n]|\\.)*"', "", source)
+
 def str_rec(x, depth=0, indent="    "):
-    try:
-        return x.str_rec(depth, indent)
-    except AttributeError:
-        return depth * indent + repr(x)
+    out = io.StringIO()
+    out.write(depth * indent)
+    write_src(x, out, depth, indent)
+    return out.getvalue()
 
 class Stmt:
+    # source line, set by the parser for statements of a program or block
+    line = None
+
     def run(self, vm):
         raise NotImplementedError
 
@@ -28,8 +68,11 @@ class Stmt:
     def dir(self):
         return dir(self)
 
+    def write_src(self, out, depth, indent):
+        out.write(repr(self))
+
     def str_rec(self, depth=0, indent="    "):
-        return indent * depth + repr(self)
+        return str_rec(self, depth, indent)
 
 
 class Expr(Stmt):
@@ -53,19 +96,17 @@ class ListExpr(Expr):
         self.exprs = exprs
 
     def get_value(self, vm):
-        return [get_value(x, vm) for x in self.exprs]
+        return vm.allocated([get_value(x, vm) for x in self.exprs])
 
     __repr__ = lambda self: f"List{self.exprs}"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        output = prefix + "["
-
-        output += ", ".join(str_rec(expr, depth + 1, "")
-                            for expr in self.exprs)
-
-        output += "]"
-        return output
+    def write_src(self, out, depth, indent):
+        out.write("[")
+        for i, expr in enumerate(self.exprs):
+            if i:
+                out.write(" ")
+            write_src(expr, out, depth + 1, "")
+        out.write("]")
 
 
 class NameExpr(Expr):
@@ -77,9 +118,8 @@ class NameExpr(Expr):
 
     __repr__ = lambda self: f"Name[{self.name}]"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        return prefix + self.name
+    def write_src(self, out, depth, indent):
+        out.write(self.name)
 
 
 class FcallExpr(Expr):
@@ -91,9 +131,9 @@ class FcallExpr(Expr):
 
     __repr__ = lambda self: f"fcall({self.func})"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        return prefix + "." +str_rec(self.func, depth, indent)[len(prefix):]
+    def write_src(self, out, depth, indent):
+        out.write(".")
+        write_src(self.func, out, depth, indent)
 
 
 class CodeBlock(Expr):
@@ -115,13 +155,14 @@ class CodeBlock(Expr):
 
     __repr__ = lambda self: "{" + joinr('; ', self.stmts) + "}"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        output = prefix + "{\n"
+    def write_src(self, out, depth, indent):
+        out.write("{\n")
         for stmt in self.stmts:
-            output += str_rec(stmt, depth+1, indent) + ";\n"
-        output += prefix + "}"
-        return output
+            out.write(indent * (depth + 1))
+            write_src(stmt, out, depth + 1, indent)
+            out.write(";\n")
+        out.write(indent * depth)
+        out.write("}")
 
 
 class Stack(Expr):
@@ -138,13 +179,13 @@ class Stack(Expr):
 
     __repr__ = lambda self: f"Stack({joinr(' ', self.exprs)})"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        output = prefix + "("
-        output += " ".join(str_rec(expr, depth + 1, "")
-                           for expr in self.exprs)
-        output += ")"
-        return output
+    def write_src(self, out, depth, indent):
+        out.write("(")
+        for i, expr in enumerate(self.exprs):
+            if i:
+                out.write(" ")
+            write_src(expr, out, depth + 1, "")
+        out.write(")")
 
 
 class IfElseExpr(Expr):
@@ -164,12 +205,13 @@ class IfElseExpr(Expr):
 
     __repr__ = lambda self: "(if {0.condition} {0.branch_then} else {0.branch_else})".format(self)
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = depth * indent
-        cond =str_rec(self.condition, depth, indent)[len(prefix):]
-        then =str_rec(self.branch_then, depth, indent)[len(prefix):]
-        else_ =str_rec(self.branch_else, depth, indent)[len(prefix):]
-        return f"{prefix} if {cond} {then} else {else_}"
+    def write_src(self, out, depth, indent):
+        out.write("if ")
+        write_src(self.condition, out, depth, indent)
+        out.write(" ")
+        write_src(self.branch_then, out, depth, indent)
+        out.write(" else ")
+        write_src(self.branch_else, out, depth, indent)
 
 class WhileExpr(Expr):
     def __init__(self, condition, body):
@@ -177,6 +219,8 @@ class WhileExpr(Expr):
         self.body = body
 
     def get_value(self, vm):
+        if vm.jit is not None:
+            return vm.jit.run_while(self)
         ret = Const.get("N")
         while get_value(self.condition, vm) == 1:
             ret = get_value(self.body, vm)
@@ -187,11 +231,11 @@ class WhileExpr(Expr):
 
     __repr__ = lambda self: "While({0.condition})=>({0.body})".format(self)
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = depth * indent
-        cond = str_rec(self.condition, depth, indent)[len(prefix):]
-        body = str_rec(self.body, depth, indent)[len(prefix):]
-        return f"{prefix} while {cond} {body}"
+    def write_src(self, out, depth, indent):
+        out.write("while ")
+        write_src(self.condition, out, depth, indent)
+        out.write(" ")
+        write_src(self.body, out, depth, indent)
 
 ["Constants"]
 
@@ -205,7 +249,7 @@ class Const(Expr):
 
         assert isinstance(self.name, str)
 
-        Const.const[self.name] = self
+        Const.const.setdefault(self.name, self)
         self.description = desc
         self.truthy = truthy
 
@@ -218,10 +262,12 @@ class Const(Expr):
     def get(name):
         if isinstance(name, NameExpr):
             name = name.name
-        if name in Const.const:
-            return Const.const[name]
-        else:
-            return Const(name)
+        const = Const.const.get(name)
+        if const is None:
+            # threads making the same constant at once all get the one
+            # that was registered first, without a lock
+            const = Const.const.setdefault(name, Const(name))
+        return const
 
     def get_value(self, vm):
         return self
@@ -232,6 +278,9 @@ class Const(Expr):
         else:
             return other.name == self.name
 
+    def __hash__(self):
+        return hash(self.name)
+
 Const("N", truthy=False)
 Const("E", truthy=False)
 Const("T", truthy=False)
@@ -244,10 +293,6 @@ class Lvalue(Expr):
     def assign(self, vm, value):
         raise NotImplementedError
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = depth * indent
-        return prefix + repr(self)
-
 class LvalueName(Lvalue):
     def __init__(self, name):
         self.name = name.name
@@ -257,9 +302,8 @@ class LvalueName(Lvalue):
 
     __repr__ = lambda self: f"LvalueName({self.name})"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = depth * indent
-        return prefix + self.name
+    def write_src(self, out, depth, indent):
+        out.write(self.name)
 
 
 class StmtAssign(Stmt):
@@ -275,10 +319,127 @@ class StmtAssign(Stmt):
 
     __repr__ = lambda self: f"Assign({self.lvalue})=({self.expr})"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        return prefix +str_rec(self.lvalue, depth, indent)[len(prefix):]\
-               + " := " +str_rec(self.expr, depth, indent)[len(prefix):]
+    def write_src(self, out, depth, indent):
+        write_src(self.lvalue, out, depth, indent)
+        out.write(" := ")
+        write_src(self.expr, out, depth, indent)
+
+["Locals"]
+
+class StmtLocal(Stmt):
+    """
+    `local a b` in a code block. It does nothing when it runs, the
+    parser has already turned the names into slots of the block.
+    """
+    def __init__(self, names):
+        self.names = names
+
+    def run(self, vm):
+        return None
+
+    __repr__ = lambda self: f"Local({' '.join(self.names)})"
+
+    def write_src(self, out, depth, indent):
+        out.write("local ")
+        out.write(" ".join(self.names))
+
+
+class LocalBlock(CodeBlock):
+    """
+    A code block with local variables. Each call gets a new frame, a
+    list with a slot per variable, so recursive calls don't see each
+    other's variables and nothing is added to the names of the VM.
+    """
+    def __init__(self, stmts, slots):
+        super().__init__(stmts)
+        self.slots = slots # variable names, by slot index
+
+    def new_frame(self):
+        return (self, [None] * len(self.slots)) # None is unassigned
+
+    def run(self, vm):
+        frames = vm.local_frames
+        frames.append(self.new_frame())
+        try:
+            return super().run(vm)
+        finally:
+            frames.pop()
+
+
+class LocalName(Expr):
+    def __init__(self, scope, slot, name):
+        self.scope = scope # the LocalBlock that declared it
+        self.slot = slot
+        self.name = name
+
+    def get_value(self, vm):
+        return vm.get_local(self.scope, self.slot)
+
+    __repr__ = lambda self: f"Local[{self.name}]"
+
+    def write_src(self, out, depth, indent):
+        out.write(self.name)
+
+
+class LvalueLocal(Lvalue):
+    def __init__(self, scope, slot, name):
+        self.scope = scope
+        self.slot = slot
+        self.name = name
+
+    def assign(self, vm, value):
+        vm.assign_local(self.scope, self.slot, value)
+
+    __repr__ = lambda self: f"LvalueLocal({self.name})"
+
+    def write_src(self, out, depth, indent):
+        out.write(self.name)
+
+
+def resolve_locals(x, scope, slots):
+    """
+    Replace the uses of the names in `slots` inside `x` by slots of
+    `scope`, returns the new `x`. Nested blocks have been resolved
+    before, so the names they declare themselves are left alone.
+    """
+    if isinstance(x, NameExpr):
+        return LocalName(scope, slots[x.name], x.name) if x.name in slots else x
+    if isinstance(x, LvalueName):
+        return LvalueLocal(scope, slots[x.name], x.name) if x.name in slots else x
+    if not isinstance(x, Stmt) or isinstance(x, (Const, LocalName, LvalueLocal)):
+        return x
+    for attr, value in list(vars(x).items()):
+        if isinstance(value, (list, tuple)):
+            setattr(x, attr, type(value)(resolve_locals(item, scope, slots)
+                                         for item in value))
+        elif isinstance(value, Stmt):
+            setattr(x, attr, resolve_locals(value, scope, slots))
+    return x
+
+["Modules"]
+
+class Namespace(CodeBlock):
+    """
+    An imported module. Its definitions are found by name without
+    scanning the statements, and each one is evaluated the first time
+    it's looked up.
+    """
+    def __init__(self, stmts):
+        super().__init__(stmts)
+        self.definitions = {}
+        for stmt in stmts:
+            if (isinstance(stmt, StmtAssign)
+                and isinstance(stmt.lvalue, LvalueName)):
+                self.definitions[stmt.lvalue.name] = stmt.expr
+        self.members = {}
+
+    def member(self, name, vm):
+        if name in self.members:
+            return self.members[name]
+        if name not in self.definitions:
+            return Const.get("N")
+        value = self.members[name] = get_value(self.definitions[name], vm)
+        return value
 
 ["Items"]
 
@@ -294,10 +455,10 @@ class LvalueIndex(Lvalue):
 
     __repr__ = lambda self: f"LvalueIndex({self.subexpr})[{self.index}]"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = depth * indent
-        return prefix + str_rec(self.subexpr, depth, indent)[len(prefix):] \
-               + "#" + str_rec(self.index, depth, indent)[len(prefix):]
+    def write_src(self, out, depth, indent):
+        write_src(self.subexpr, out, depth, indent)
+        out.write("#")
+        write_src(self.index, out, depth, indent)
 
 
 class GetitemExpr(Expr):
@@ -311,10 +472,10 @@ class GetitemExpr(Expr):
 
     __repr__ = lambda self: f"Getitem({self.subexpr})[{self.index}]"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = depth * indent
-        return prefix + str_rec(self.subexpr, depth, indent)[len(prefix):] \
-               + "#" + str_rec(self.index, depth, indent)[len(prefix):]
+    def write_src(self, out, depth, indent):
+        write_src(self.subexpr, out, depth, indent)
+        out.write("#")
+        write_src(self.index, out, depth, indent)
 
 
 class AtExpr(Expr):
@@ -326,21 +487,38 @@ class AtExpr(Expr):
 
     __repr__ = lambda self: f"@({self.expr})"
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        return prefix + "@" +str_rec(self.expr, depth, indent)[len(prefix):]
+    def write_src(self, out, depth, indent):
+        out.write("@")
+        write_src(self.expr, out, depth, indent)
 
 
 class RangeExpr(Expr):
     def __init__(self, left_expr, right_expr):
         self.left_expr = left_expr
         self.right_expr = right_expr
-        self.left = None
-        self.right = None
 
     def get_value(self, vm):
-        self.left = get_value(self.left_expr, vm)
-        self.right = get_value(self.right_expr, vm)
+        return Range(get_value(self.left_expr, vm),
+                     get_value(self.right_expr, vm))
+
+    def write_src(self, out, depth, indent):
+        write_src(self.left_expr, out, depth, indent)
+        out.write("..")
+        write_src(self.right_expr, out, depth, indent)
+
+    __repr__ = lambda self: f"Range[{self.left_expr}..{self.right_expr}]"
+
+
+class Range(Expr):
+    """
+    The value of a range expression. It's a new object every time, so
+    that the expression itself isn't changed by running it.
+    """
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def get_value(self, vm):
         return self
 
     def __contains__(self, item):
@@ -353,11 +531,12 @@ class RangeExpr(Expr):
             yield left
             left += 1
 
-    def str_rec(self, depth=0, indent="    "):
-        prefix = indent * depth
-        return prefix + str_rec(self.left_expr) + ".." + str_rec(self.right_expr)
+    def write_src(self, out, depth, indent):
+        write_src(self.left, out, depth, indent)
+        out.write("..")
+        write_src(self.right, out, depth, indent)
 
-    __repr__ = lambda self: f"Range[{self.left_expr}..{self.right_expr}]"
+    __repr__ = lambda self: f"Range[{self.left!r}..{self.right!r}]"
 
 
 
@@ -374,6 +553,17 @@ STAR = lambda f: lambda self, *args: f(args)
 
 @v_args(inline=True)
 class Tranny(Transformer):
+    def _call_userfunc(self, tree, new_children=None):
+        result = super()._call_userfunc(tree, new_children)
+        if tree.data in ("start", "code_block"):
+            # remember where statements start, for breakpoints
+            stmts = result.children if tree.data == "start" else result.stmts
+            for child, stmt in zip(tree.children, stmts):
+                if isinstance(stmt, Stmt) and not isinstance(stmt, Const):
+                    stmt.line = getattr(getattr(child, "meta", child),
+                                        "line", None)
+        return result
+
     def lvalue_name(self, name):
         return LvalueName(name)
 
@@ -385,6 +575,9 @@ class Tranny(Transformer):
     def stmt_assign(self, lvalue, expr):
         return StmtAssign(lvalue, expr)
 
+    def stmt_local(self, *names):
+        return StmtLocal([name.name for name in names])
+
     ["Conditionals"]
 
     expr_while = WhileExpr
@@ -410,8 +603,18 @@ class Tranny(Transformer):
 
     stack = STAR(Stack)
 
-    code_block = STAR(CodeBlock)
-
+    def code_block(self, *stmts):
+        slots = {}
+        for stmt in stmts:
+            if isinstance(stmt, StmtLocal):
+                for name in stmt.names:
+                    slots.setdefault(name, len(slots))
+        if not slots:
+            return CodeBlock(stmts)
+        block = LocalBlock(stmts, list(slots))
+        block.stmts = tuple(resolve_locals(stmt, block, slots)
+                            for stmt in stmts)
+        return block
 
 
     def name(self, name):
@@ -432,14 +635,11 @@ class Tranny(Transformer):
 
 
 class StekkSyntaxError(SyntaxError):
-    def __init__(self, error):
+    def __init__(self, error, exception=None):
         self.error = error
+        self.exception = exception # what Lark raised
 
 
-
-
-
-LAST_EXC = None
 ERROR_LOOKUP = [
     ("Syntax error (maybe missing ';' ?)", {'LESSTHAN', 'SEMICOLON', '__ANON_0', '__ANON_1'}),
     ("Missing ]", {'RSQB'}),
@@ -447,17 +647,93 @@ ERROR_LOOKUP = [
 ]
 
 _path, _ = os.path.split(__file__)
-
-with open(os.path.join(_path, "lang_grammar.lark")) as file:
-    parser = Lark(file)
+GRAMMAR_PATH = os.path.join(_path, "lang_grammar.lark")
+# the grammar compiled into terminals and rules, which takes most of the
+# time of building the parser; `python -m stekk compile-grammar` writes
+# it again after the grammar changes
+COMPILED_PATH = os.path.join(_path, "lang_grammar.json")
+PARSER_OPTIONS = {"propagate_positions": True}
+
+# built on first use by get_parser()
+parser = None
+parser_lock = threading.Lock()
+
+def grammar_hash(source):
+    """what a compiled grammar has to have been compiled from"""
+    key = f"{source}\0{lark_version}\0{sorted(PARSER_OPTIONS.items())}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def compile_grammar(source):
+    """the grammar as JSON-ready data, for parser_from_compiled"""
+    lark = Lark(source, **PARSER_OPTIONS)
+    return {
+        "hash": grammar_hash(source),
+        # what Lark worked out from the "auto" options
+        "options": {name: getattr(lark.options, name)
+                    for name in ("lexer", "ambiguity", "priority")},
+        "terminals": [terminal.serialize() for terminal in lark.terminals],
+        "rules": [rule.serialize() for rule in lark.rules],
+        "ignore": list(lark.ignore_tokens),
+    }
+
+def parser_from_compiled(compiled):
+    """
+    The second half of Lark.__init__, from the compiled grammar on;
+    Lark can only load whole parsers that use LALR
+    """
+    lark = Lark.__new__(Lark)
+    lark.options = LarkOptions({**PARSER_OPTIONS, **compiled["options"]})
+    lark.source_path = GRAMMAR_PATH
+    lark.terminals = [TerminalDef.deserialize(terminal, {})
+                      for terminal in compiled["terminals"]]
+    lark.rules = [Rule.deserialize(rule, {}) for rule in compiled["rules"]]
+    lark.ignore_tokens = compiled["ignore"]
+    lark._terminals_dict = {terminal.name: terminal
+                            for terminal in lark.terminals}
+    lark.lexer_conf = LexerConf(lark.terminals, re, lark.ignore_tokens,
+                                None, {}, 0, use_bytes=False)
+    lark.parser = lark._build_parser()
+    return lark
+
+def write_compiled_grammar():
+    with open(GRAMMAR_PATH) as file:
+        compiled = compile_grammar(file.read())
+    with open(COMPILED_PATH, "w") as file:
+        json.dump(compiled, file, indent=1)
+        file.write("\n")
+
+def load_parser():
+    """
+    Build the parser from the compiled grammar that comes with the
+    package, or from the grammar if that's been changed since, or Lark
+    has. The compiled grammar is JSON, so unlike a pickled cache,
+    loading it can't run code.
+    """
+    with open(GRAMMAR_PATH) as file:
+        source = file.read()
+    try:
+        with open(COMPILED_PATH) as file:
+            compiled = json.load(file)
+    except (OSError, ValueError):
+        compiled = None
+    if compiled is None or compiled.get("hash") != grammar_hash(source):
+        return Lark(source, **PARSER_OPTIONS)
+    return parser_from_compiled(compiled)
+
+def get_parser():
+    global parser
+    if parser is None:
+        with parser_lock:
+            if parser is None:
+                parser = load_parser()
+    return parser
 
 def parse(program):
     error = False
     try:
-        x = parser.parse(program)
+        x = get_parser().parse(program)
     except UnexpectedInput as u:
-        global LAST_EXC
-        LAST_EXC = u
+        exception = u
         for message, subset in ERROR_LOOKUP:
             if subset <= u.allowed: # is subset?
                 error = f"{message} at line {u.line}:\n{u.get_context(program)}"
@@ -467,6 +743,10 @@ def parse(program):
             error = f"Syntax error at line {u.line}::{u.allowed}"
 
     if error:
-        raise StekkSyntaxError(error)
+        raise StekkSyntaxError(error, exception)
     statements = Tranny().transform(x).children
+    for stmt in statements:
+        if isinstance(stmt, StmtLocal):
+            raise StekkSyntaxError(
+                f"local outside of a code block at line {stmt.line}")
     return statements
@@ -0,0 +1,108 @@
+import itertools
+
+# shorter strings are cheaper to copy than to keep in pieces
+MIN_LENGTH = 256
+
+
+class Rope:
+    """
+    A string made by `++`, kept as a list of parts until it's needed
+    as a whole. Ropes made by appending to each other share the list:
+    appending to the rope that owns the end of the list adds to it in
+    place, so building a string piece by piece takes linear time.
+    """
+    __slots__ = ("parts", "count", "length")
+
+    def __init__(self, parts, count, length):
+        self.parts = parts # may be shared with longer ropes
+        self.count = count # how many of the parts belong to this rope
+        self.length = length
+
+    def append(self, string):
+        parts = self.parts
+        if len(parts) != self.count: # somebody appended to us already
+            parts = parts[:self.count]
+        parts.append(string)
+        return Rope(parts, self.count + 1, self.length + len(string))
+
+    def chunks(self):
+        """the parts, without joining them"""
+        return itertools.islice(self.parts, self.count)
+
+    def __str__(self):
+        if self.count != 1:
+            self.parts = ["".join(self.chunks())]
+            self.count = 1
+        return self.parts[0]
+
+    __repr__ = lambda self: repr(str(self))
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        for part in self.chunks():
+            yield from part
+
+    def __getitem__(self, index):
+        return str(self)[index]
+
+    def __contains__(self, item):
+        return flatten(item) in str(self)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __eq__(self, other):
+        if isinstance(other, (str, Rope)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, (str, Rope)):
+            return str(self) != str(other)
+        return NotImplemented
+
+    def __lt__(self, other):
+        return str(self) < flatten(other)
+
+    def __le__(self, other):
+        return str(self) <= flatten(other)
+
+    def __gt__(self, other):
+        return str(self) > flatten(other)
+
+    def __ge__(self, other):
+        return str(self) >= flatten(other)
+
+    def __add__(self, other):
+        if isinstance(other, (str, Rope)):
+            return concat(self, other)
+        return NotImplemented
+
+    def __radd__(self, other):
+        if isinstance(other, str):
+            return concat(other, self)
+        return NotImplemented
+
+
+def flatten(value):
+    """the string for a rope, anything else as it is"""
+    return str(value) if isinstance(value, Rope) else value
+
+
+def concat(left, right):
+    """left ++ right for strings and ropes"""
+    if isinstance(right, Rope):
+        if not isinstance(left, Rope):
+            return Rope([left, *right.chunks()], right.count + 1,
+                        len(left) + right.length)
+        right = str(right)
+    if isinstance(left, Rope):
+        return left.append(right)
+    if len(left) + len(right) < MIN_LENGTH:
+        return left + right
+    return Rope([left, right], 2, len(left) + len(right))
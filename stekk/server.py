@@ -0,0 +1,328 @@
+import argparse
+import collections
+import http.server
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socketserver
+import stat
+import threading
+import time
+
+from .parser import StekkSyntaxError, get_parser, parse
+from .vm import VM
+
+# workers are forked from the supervisor after the parser is built,
+# so they start with the parser and the built-ins already loaded
+context = multiprocessing.get_context("fork")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def no_input():
+    raise EOFError("no input in server mode")
+
+def run_program(source, operations_limit, memory_limit=None):
+    output = []
+    def printer(*values, end="\n"):
+        output.append(" ".join(map(str, values)) + end)
+
+    vm = VM([], printer=printer, reader=no_input,
+            operations_limit=operations_limit, memory_limit=memory_limit)
+    error = stats = None
+    try:
+        try:
+            start = time.perf_counter()
+            vm.statements.extend(parse(source))
+            vm.stats.parse_time += time.perf_counter() - start
+            vm.run()
+        finally:
+            # inside, so whatever goes wrong measuring is an error too
+            stats = vm.stats.as_dict(vm)
+    except StekkSyntaxError as e:
+        error = str(e.error)
+    except Exception as e:
+        error = f"{e.__class__.__name__}: {e}"
+    return {
+        "output": "".join(output),
+        "stack": [repr(x) for x in vm.stack],
+        "result": None if vm.last_result is None else repr(vm.last_result),
+        "operations": vm.operations,
+        "stats": stats,
+        "error": error,
+    }
+
+def worker_main(connection, supervisor_end, operations_limit, memory_limit):
+    # the forked copy of the supervisor's end would keep the pipe open,
+    # and the worker wouldn't notice that the supervisor is gone
+    supervisor_end.close()
+    get_parser() # already built unless this worker replaced a stuck one
+    while True:
+        try:
+            source = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        connection.send(run_program(source, operations_limit, memory_limit))
+
+
+class Worker:
+    def __init__(self, operations_limit, memory_limit):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=worker_main,
+                                        args=(child, self.connection,
+                                              operations_limit, memory_limit),
+                                        daemon=True)
+        self.process.start()
+        child.close()
+
+    def memory(self):
+        """resident memory in bytes, None where /proc isn't available"""
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as file:
+                return int(file.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class Metrics:
+    def __init__(self, keep=1000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=keep)
+        self.counts = collections.Counter()
+
+    def record(self, outcome, seconds):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts[outcome] += 1
+            self.latencies.append(seconds)
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            index = min(len(latencies) - 1, int(p / 100 * len(latencies)))
+            return round(latencies[index] * 1000, 3)
+
+        return {
+            **counts,
+            "latency_ms": {
+                "mean": (round(sum(latencies) / len(latencies) * 1000, 3)
+                         if latencies else None),
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "p99": percentile(99),
+                "max": percentile(100),
+            },
+        }
+
+
+class Supervisor:
+    """
+    Hands programs to a pool of worker processes, and kills and replaces
+    the ones that go over the time or memory limit
+    """
+    poll_interval = 0.02
+
+    def __init__(self, workers=4, time_limit=5.0,
+                 memory_limit=256 * 2**20, operations_limit=10**7):
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.operations_limit = operations_limit
+        self.metrics = Metrics()
+        get_parser()
+        self.workers = []
+        self.idle = queue.Queue()
+        for _ in range(workers):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        # the VM stops a program that builds huge values with an error
+        # before the worker gets big enough to be killed; the rest of the
+        # process is the interpreter itself and what the VM can't see
+        worker = Worker(self.operations_limit, self.memory_limit // 2)
+        self.workers.append(worker)
+        return worker
+
+    def replace(self, worker):
+        worker.kill()
+        self.workers.remove(worker)
+        return self.spawn()
+
+    def wait(self, worker, start):
+        """returns (outcome, result) of the program the worker is running"""
+        while True:
+            if worker.connection.poll(self.poll_interval):
+                try:
+                    return "ok", worker.connection.recv()
+                except EOFError:
+                    return "crashed", None
+            if time.monotonic() - start > self.time_limit:
+                return "timeout", None
+            memory = worker.memory()
+            if memory is not None and memory > self.memory_limit:
+                return "memory", None
+            if not worker.process.is_alive():
+                return "crashed", None
+
+    def run(self, source):
+        worker = self.idle.get()
+        start = time.monotonic()
+        outcome, result = "crashed", None
+        try:
+            worker.connection.send(source)
+            outcome, result = self.wait(worker, start)
+        except (BrokenPipeError, EOFError):
+            outcome, result = "crashed", None
+        finally:
+            if outcome != "ok":
+                worker = self.replace(worker)
+            self.idle.put(worker)
+
+        elapsed = time.monotonic() - start
+        if outcome == "ok" and result["error"] is not None:
+            outcome = "error"
+        self.metrics.record(outcome, elapsed)
+
+        if result is None:
+            messages = {
+                "timeout": f"time limit of {self.time_limit}s exceeded",
+                "memory": f"memory limit of {self.memory_limit} bytes exceeded",
+                "crashed": "worker crashed",
+            }
+            result = {"output": "", "stack": [], "result": None,
+                      "operations": None, "stats": None,
+                      "error": messages[outcome]}
+        result["elapsed_ms"] = round(elapsed * 1000, 3)
+        return result
+
+    def close(self):
+        for worker in self.workers:
+            worker.kill()
+        self.workers = []
+
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+    """POST /run with the program as the body, GET /metrics"""
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != "/run":
+            return self.send_json(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length", 0))
+        source = self.rfile.read(length).decode("utf8")
+        self.send_json(200, self.server.supervisor.run(source))
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            return self.send_json(404, {"error": "not found"})
+        self.send_json(200, self.server.supervisor.metrics.summary())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    """
+    one JSON object per line:
+    {"program": "..."} runs a program, {"metrics": true} returns metrics
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"error": "invalid JSON"}
+            else:
+                if request.get("metrics"):
+                    response = self.server.supervisor.metrics.summary()
+                else:
+                    response = self.server.supervisor.run(
+                        str(request.get("program", "")))
+            self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def socket_id(path):
+    """(device, inode) of the socket at `path`, None if there's none"""
+    try:
+        status = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISSOCK(status.st_mode):
+        return None
+    return status.st_dev, status.st_ino
+
+def stop(signum, frame):
+    raise SystemExit(0)
+
+def main(args):
+    arg_parser = argparse.ArgumentParser(
+        prog="python -m stekk serve",
+        description="run stekk programs sent over a Unix socket or HTTP")
+    where = arg_parser.add_mutually_exclusive_group(required=True)
+    where.add_argument("--socket", help="path of a Unix socket to listen on")
+    where.add_argument("--port", type=int, help="HTTP port on localhost")
+    arg_parser.add_argument("--workers", type=int, default=4)
+    arg_parser.add_argument("--time-limit", type=float, default=5.0,
+                            help="seconds per request")
+    arg_parser.add_argument("--memory-limit", type=int, default=256,
+                            help="megabytes per worker")
+    arg_parser.add_argument("--ops-limit", type=int, default=10**7,
+                            help="operations per request")
+    options = arg_parser.parse_args(args)
+    if options.socket is not None and os.path.lexists(options.socket):
+        # a socket left behind by a server that's gone; anything else
+        # at that path isn't ours to delete
+        if not stat.S_ISSOCK(os.lstat(options.socket).st_mode):
+            arg_parser.error(f"{options.socket} exists and isn't a socket")
+        os.remove(options.socket)
+
+    supervisor = Supervisor(workers=options.workers,
+                            time_limit=options.time_limit,
+                            memory_limit=options.memory_limit * 2**20,
+                            operations_limit=options.ops_limit)
+    created = None # (device, inode) of the socket this process made
+    if options.socket is not None:
+        server = UnixServer(options.socket, SocketHandler)
+        created = socket_id(options.socket)
+        print(f"listening on {options.socket}")
+    else:
+        server = HTTPServer(("127.0.0.1", options.port), HTTPHandler)
+        print(f"listening on http://127.0.0.1:{options.port}")
+    server.supervisor = supervisor
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        supervisor.close()
+        # another server may have replaced it since
+        if created is not None and socket_id(options.socket) == created:
+            os.remove(options.socket)
@@ -0,0 +1,87 @@
+import io
+import pickle
+import struct
+
+from . import parser
+from .parser import Const, Stmt
+from .rope import Rope
+
+MAGIC = b"stekk-vm"
+VERSION = 1
+HEADER = struct.Struct(">8sH")
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class SnapshotPickler(pickle.Pickler):
+    """
+    Pickles VM state. Built-ins are stored by name and constants by
+    their `$name`, so they come back as the objects of the running
+    interpreter rather than copies.
+    """
+    def __init__(self, file, builtins):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.builtin_names = {id(func): name for name, func in builtins.items()}
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Const):
+            return ("const", obj.name)
+        if isinstance(obj, Rope):
+            return ("string", str(obj))
+        name = self.builtin_names.get(id(obj))
+        if name is not None:
+            return ("builtin", name)
+        return None
+
+
+class SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, file, builtins):
+        super().__init__(file)
+        self.builtins = builtins
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind == "const":
+            return Const.get(name)
+        elif kind == "string":
+            return name
+        elif kind == "builtin" and name in self.builtins:
+            return self.builtins[name]
+        raise SnapshotError(f"unknown reference in snapshot: {pid}")
+
+    def find_class(self, module, name):
+        # only syntax tree nodes can be stored, so loading a snapshot
+        # can't be used to call arbitrary functions
+        if module == parser.__name__:
+            cls = getattr(parser, name, None)
+            if isinstance(cls, type) and issubclass(cls, Stmt):
+                return cls
+        raise SnapshotError(f"can't restore {module}.{name} from a snapshot")
+
+
+def dump(state, builtins):
+    file = io.BytesIO()
+    file.write(HEADER.pack(MAGIC, VERSION))
+    try:
+        SnapshotPickler(file, builtins).dump(state)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise SnapshotError(f"can't snapshot this state: {e}")
+    return file.getvalue()
+
+def load(data, builtins):
+    if len(data) < HEADER.size:
+        raise SnapshotError("not a stekk snapshot")
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("not a stekk snapshot")
+    if version != VERSION:
+        raise SnapshotError(f"unsupported snapshot version {version}")
+
+    file = io.BytesIO(data)
+    file.seek(HEADER.size)
+    try:
+        return SnapshotUnpickler(file, builtins).load()
+    except (pickle.UnpicklingError, EOFError) as e:
+        raise SnapshotError(f"corrupt snapshot: {e}")
@@ -0,0 +1,302 @@
+from .parser import Stack, FcallExpr, CodeBlock, NameExpr, Const,\
+                    ListExpr, IfElseExpr, WhileExpr, AtExpr, RangeExpr,\
+                    GetitemExpr, StmtAssign, LvalueName, LvalueIndex,\
+                    StmtLocal, LocalName, LvalueLocal
+
+# what evaluating an expression gives back to whoever evaluates it
+VALUE = "value"
+NOTHING = "nothing"
+MAYBE = "maybe"
+
+
+class Unknown(Exception):
+    """the stack effect can't be worked out statically"""
+
+
+class StackEffect:
+    """
+    `needs` is how many values must already be on the stack,
+    `delta` is how the stack height changes,
+    `returns` is what calling the block evaluates to
+    """
+    def __init__(self, needs, delta, returns=NOTHING,
+                 calls=frozenset(), assigns=frozenset()):
+        self.needs = needs
+        self.delta = delta
+        self.returns = returns
+        self.calls = calls
+        self.assigns = assigns
+
+    __repr__ = lambda self: f"StackEffect(needs={self.needs}, delta={self.delta})"
+
+    def __str__(self):
+        returns = {VALUE: ", returns a value", MAYBE: ", may return a value"}
+        return (f"needs {self.needs}, leaves {self.delta:+d}"
+                + returns.get(self.returns, ""))
+
+
+def split_items(text):
+    """split a stack picture into items, None if its size isn't fixed"""
+    items = []
+    depth = 0
+    current = ""
+    for char in text + " ":
+        if char in "[({":
+            depth += 1
+        elif char in "])}":
+            depth -= 1
+        if char.isspace() and depth == 0:
+            if current == "...":
+                return None
+            if current:
+                items.append(current)
+            current = ""
+        else:
+            current += char
+    return items
+
+def parse_effect(text, arity=None):
+    """
+    "a b -- b a" -> StackEffect(needs=2, delta=0)
+    None if the text doesn't describe a fixed stack effect
+    """
+    if not isinstance(text, str) or text.count("--") != 1 or ";" in text:
+        return None
+
+    before, after = text.split("--")
+    inputs = split_items(before)
+    outputs = split_items(after)
+    if inputs is None or outputs is None:
+        return None
+    if arity is not None and len(inputs) != arity:
+        return None
+    return StackEffect(len(inputs), len(outputs) - len(inputs))
+
+
+class Analyser:
+    """
+    Walks a syntax tree the way VM would, but only keeps track of the
+    stack height. With `base` set to the stack height at the start, the
+    height is known exactly and pops from an empty stack are reported;
+    with `base=None` the analyser instead works out how many values
+    have to be on the stack for no pop to come up empty.
+    """
+    def __init__(self, names, block_effect=None, base=None):
+        self.names = names
+        self.block_effect = block_effect
+        self.base = base
+        self.depth = 0
+        self.needs = 0
+        self.calls = set()
+        self.assigns = set()
+        self.bindings = {}
+        self.active = set()
+        self.where = None
+        self.diagnostics = []
+
+    def push(self):
+        self.depth += 1
+
+    def pop(self, checked, what):
+        """returns whether something was popped"""
+        if self.base is None:
+            self.needs = max(self.needs, 1 - self.depth)
+            self.depth -= 1
+            return True
+        elif self.base + self.depth > 0:
+            self.depth -= 1
+            return True
+        else:
+            if checked:
+                self.diagnostics.append(
+                    (self.where, f"{what} pops from an empty stack"))
+            return False
+
+    def consume(self, kind):
+        if kind == VALUE:
+            self.push()
+        elif kind == MAYBE:
+            raise Unknown("can't tell whether a value is pushed")
+
+    def block_body(self, block):
+        kind = NOTHING
+        for stmt in block.stmts:
+            kind = self.expr(stmt)
+        return kind
+
+    def expr(self, x):
+        if isinstance(x, Stack):
+            for expr in x.exprs:
+                self.consume(self.expr(expr))
+            return VALUE if self.pop(False, "()") else NOTHING
+
+        elif isinstance(x, FcallExpr):
+            return self.call(x.func)
+
+        elif isinstance(x, StmtAssign):
+            self.expr(x.expr)
+            if isinstance(x.lvalue, LvalueName):
+                self.assigns.add(x.lvalue.name)
+                self.bindings[x.lvalue.name] = (
+                    x.expr if isinstance(x.expr, CodeBlock) else None)
+            elif isinstance(x.lvalue, LvalueLocal):
+                pass # locals aren't looked up as functions here
+            elif isinstance(x.lvalue, LvalueIndex):
+                self.expr(x.lvalue.subexpr)
+                self.expr(x.lvalue.index)
+            else:
+                raise Unknown(f"can't assign to {x.lvalue!r}")
+            return NOTHING
+
+        elif isinstance(x, IfElseExpr):
+            self.expr(x.condition)
+            start = self.depth
+            then_kind = self.expr(x.branch_then)
+            then_depth = self.depth
+            self.depth = start
+            else_kind = self.expr(x.branch_else)
+            if self.depth != then_depth:
+                raise Unknown("if branches leave different stack heights")
+            return then_kind if then_kind == else_kind else MAYBE
+
+        elif isinstance(x, WhileExpr):
+            start = self.depth
+            self.expr(x.condition)
+            after_condition = self.depth
+            self.expr(x.body)
+            if self.depth != start:
+                raise Unknown("loop changes the stack height")
+            self.depth = after_condition
+            return VALUE
+
+        elif isinstance(x, ListExpr):
+            for expr in x.exprs:
+                self.expr(expr)
+            return VALUE
+
+        elif isinstance(x, AtExpr):
+            self.expr(x.expr)
+            return VALUE
+
+        elif isinstance(x, RangeExpr):
+            self.expr(x.left_expr)
+            self.expr(x.right_expr)
+            return VALUE
+
+        elif isinstance(x, GetitemExpr):
+            # indexing a code block runs its statements
+            raise Unknown("can't follow indexing")
+
+        elif isinstance(x, (CodeBlock, Const, NameExpr, LocalName,
+                            int, float, str)):
+            return VALUE
+
+        elif isinstance(x, StmtLocal):
+            return NOTHING
+
+        else:
+            raise Unknown(f"can't follow {x!r}")
+
+    def lookup(self, name):
+        if name in self.bindings:
+            func = self.bindings[name]
+        elif name in self.names:
+            func = self.names[name]
+        else:
+            raise Unknown(f"{name} is not defined")
+        if func is None:
+            raise Unknown(f"{name} is not a known function")
+        return func
+
+    def call(self, func_expr):
+        if isinstance(func_expr, NameExpr):
+            name = func_expr.name
+            self.calls.add(name)
+            func = self.lookup(name)
+        elif isinstance(func_expr, CodeBlock):
+            name = "{...}"
+            func = func_expr
+        else:
+            raise Unknown("can't tell which function is called")
+
+        if isinstance(func, CodeBlock):
+            return self.call_block(func)
+
+        effect = getattr(func, "effect", None)
+        if effect is None:
+            raise Unknown(f"{name} has no declared stack effect")
+        for _ in range(effect.needs):
+            self.pop(True, name)
+        self.depth += effect.needs + effect.delta
+        return NOTHING
+
+    def call_block(self, block):
+        if self.base is None:
+            effect = self.block_effect(block)
+            self.needs = max(self.needs, effect.needs - self.depth)
+            self.depth += effect.delta
+            self.calls |= effect.calls
+            self.assigns |= effect.assigns
+            return effect.returns
+
+        # the height is known here, so follow the block's body directly
+        if id(block) in self.active:
+            raise Unknown("recursive block")
+        self.active.add(id(block))
+        try:
+            return self.block_body(block)
+        finally:
+            self.active.remove(id(block))
+
+
+def analyse_block(block, names, block_effect):
+    analyser = Analyser(names, block_effect)
+    returns = analyser.block_body(block)
+    if analyser.calls & analyser.assigns:
+        raise Unknown("block reassigns a name that it calls")
+    return StackEffect(analyser.needs, analyser.depth, returns,
+                       frozenset(analyser.calls), frozenset(analyser.assigns))
+
+
+class EffectCache:
+    """
+    Remembers the effects of code blocks while checking one program.
+    The effects depend on what the called names are bound to, so a
+    cache is only good for one set of names.
+    """
+    def __init__(self):
+        self.effects = {}
+
+    def lookup(self, block, names):
+        entry = self.effects.get(id(block))
+        if entry is None or entry[0] is not block:
+            self.effects[id(block)] = (block, Unknown("recursive block"))
+            try:
+                result = analyse_block(block, names,
+                                       lambda b: self.lookup(b, names))
+            except Unknown as e:
+                result = e
+            entry = self.effects[id(block)] = (block, result)
+
+        result = entry[1]
+        if isinstance(result, Unknown):
+            raise Unknown(*result.args)
+        return result
+
+
+def check_program(statements, names):
+    """
+    Follow the top level of a program starting from an empty stack.
+    Returns a list of (statement index, message) for pops that would get
+    $N and for the place where the stack couldn't be followed further,
+    and the names the program binds (code blocks, or None).
+    """
+    analyser = Analyser(names, base=0)
+    for index, stmt in enumerate(statements):
+        analyser.where = index
+        try:
+            analyser.expr(stmt)
+        except Unknown as e:
+            analyser.diagnostics.append((index, f"stopped checking: {e}"))
+            break
+    return analyser.diagnostics, analyser.bindings
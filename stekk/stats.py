@@ -0,0 +1,83 @@
+# What a VM did during a run. The VM bumps its counters itself, as plain
+# integer attributes next to where it charges operations, so they are
+# always there and nothing is computed until the numbers are asked for.
+
+import json
+
+# category -> counter attribute of the VM
+CATEGORIES = {
+    "push": "pushes",
+    "pop": "pops",
+    "lookup": "lookups",
+    "call": "calls",
+    "assignment": "assignments",
+}
+
+FORMATS = ("json", "prometheus")
+
+
+class Stats:
+    """
+    The rest of what a run did, and the counters of the VM as a whole:
+    operations by category, as charged through the VM's own methods,
+    with whatever compiled code and batched loops charge counted as
+    "other"; `stack_peak` is the deepest the stack got when something
+    was pushed on it through the VM, `call_depth_peak` the deepest code
+    blocks were called inside each other.
+    """
+    def __init__(self):
+        self.modules = []
+        self.wall_time = 0.0
+        self.parse_time = 0.0
+
+    def as_dict(self, vm):
+        operations = {category: getattr(vm, counter)
+                      for category, counter in CATEGORIES.items()}
+        operations["other"] = vm.operations - sum(operations.values())
+        return {
+            "operations": vm.operations,
+            "operations_by_category": operations,
+            "stack_peak": vm.stack_peak,
+            "call_depth_peak": vm.call_depth_peak,
+            # measures once more, so short runs have a peak too
+            "memory_peak_bytes": vm.memory.report()["peak"],
+            "modules": list(self.modules),
+            "wall_seconds": self.wall_time,
+            "parse_seconds": self.parse_time,
+        }
+
+    def to_json(self, vm):
+        return json.dumps(self.as_dict(vm), indent=4) + "\n"
+
+    def to_prometheus(self, vm):
+        """the text exposition format, one metric family at a time"""
+        stats = self.as_dict(vm)
+        lines = []
+        def family(name, kind, help_, samples):
+            lines.append(f"# HELP stekk_{name} {help_}")
+            lines.append(f"# TYPE stekk_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"stekk_{name}{labels} {value}")
+
+        family("operations_total", "counter", "Operations charged by category.",
+               [(f'{{category="{category}"}}', count) for category, count
+                in stats["operations_by_category"].items()])
+        family("stack_peak", "gauge", "Deepest stack seen.",
+               [("", stats["stack_peak"])])
+        family("call_depth_peak", "gauge", "Deepest nesting of block calls.",
+               [("", stats["call_depth_peak"])])
+        family("memory_peak_bytes", "gauge", "Largest measured memory use.",
+               [("", stats["memory_peak_bytes"])])
+        family("modules_imported_total", "counter", "Modules imported.",
+               [("", len(stats["modules"]))])
+        family("wall_seconds_total", "counter", "Time spent running.",
+               [("", stats["wall_seconds"])])
+        family("parse_seconds_total", "counter", "Time spent parsing.",
+               [("", stats["parse_seconds"])])
+        return "\n".join(lines) + "\n"
+
+    def export(self, vm, path, format="json"):
+        text = (self.to_prometheus(vm) if format == "prometheus"
+                else self.to_json(vm))
+        with open(path, "w") as file:
+            file.write(text)
@@ -0,0 +1,56 @@
+END = "" # never a character of a name, so it can mark the end of a word
+
+
+class PrefixTrie:
+    """
+    A set of strings that can list its members starting with a prefix
+    without scanning all of them. The VM keeps one over its names for
+    tab completion.
+    """
+    def __init__(self, words=()):
+        self.root = {}
+        self.size = 0
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        if END not in node:
+            node[END] = True
+            self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, word):
+        node = self._find(word)
+        return node is not None and END in node
+
+    def _find(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def has_prefix(self, prefix):
+        return self._find(prefix) is not None
+
+    def with_prefix(self, prefix):
+        """all words starting with `prefix`, in sorted order"""
+        node = self._find(prefix)
+        if node is None:
+            return []
+
+        words = []
+        pending = [(prefix, node)]
+        while pending:
+            word, node = pending.pop()
+            if END in node:
+                words.append(word)
+            for char in sorted((c for c in node if c != END), reverse=True):
+                pending.append((word + char, node[char]))
+        return words
@@ -1,15 +1,31 @@
 from .parser import Expr, Stmt,\
-                    NameExpr, AtExpr, GetitemExpr, RangeExpr,\
-                    FcallExpr, CodeBlock, Stack, IfElseExpr,\
+                    NameExpr, AtExpr, GetitemExpr, Range,\
+                    FcallExpr, CodeBlock, Namespace, Stack, IfElseExpr,\
                     Const, StmtAssign,\
                     Lvalue, LvalueName, LvalueIndex,\
-                    get_value
-
-from .util import withrepr
+                    get_value, str_rec
+
+from .util import withrepr, StrWrapper
+from .stack_effect import parse_effect
+from .trie import PrefixTrie
+from .rope import Rope, concat, flatten
+from .lazy import Lazy
+from . import snapshot
+from .jit import Jit
+from .parallel import run_parallel
+from .arithmetic import get_arithmetic
+from .memory import MemoryMeter
+from .stats import Stats
 
 from .parser import parse
 
+import bisect
 import inspect
+import itertools
+import struct
+import sys
+import time
+import types
 
 import os
 
@@ -18,6 +34,28 @@ error = Const.get("E")
 type_error = Const.get("T")
 ok = Const.get("OK")
 
+# values that * repeats
+SEQUENCES = (list, str)
+
+# bytes of an empty list and string, and of each item in a list
+EMPTY_LIST = sys.getsizeof([])
+EMPTY_STR = sys.getsizeof("")
+POINTER = struct.calcsize("P")
+# about the bytes per item of a set, with its table a third empty
+SET_ITEM = 4 * POINTER
+# items of a lazy sequence taken between charges for the list they go in
+LIST_CHUNK = 4096
+# operations between charges for what the stack has grown by
+STACK_CHECK_EVERY = 1024
+
+# how many loop iterations times and for charge for at once
+LOOP_BATCH = 1024
+
+class LoopBreak(Exception):
+    """raised by the break built-in, caught by times and for"""
+    def __init__(self):
+        super().__init__("break outside of a times or for loop")
+
 def ensure_types(*value_types):
     for (value, type_) in value_types:
         if not isinstance(value, type_):
@@ -27,6 +65,12 @@ def ensure_types(*value_types):
 def ensure_numbers(*values):
     return ensure_types(*((value, (int, float)) for value in values))
 
+def hash_key(value):
+    """a hashable stand-in for a value, the same for values that are ="""
+    if isinstance(value, list):
+        return tuple(map(hash_key, value))
+    return value
+
 vm_builtins = {}
 
 def vm_builtin(func):
@@ -38,6 +82,7 @@ def vm_builtin_as(name):
         func.name = name
         new_func = withrepr(builtin_function_repr(func))(func)
         new_func.help = func.__doc__ or ""
+        new_func.effect = None
         vm_builtins[name] = new_func
         return new_func
     return wrapper
@@ -51,7 +96,18 @@ def builtin_function_repr(original_function):
     return repr_
 
 
-def vm_onstack(n, name=None, trustme=True):
+def apply_onstack(vm, func, args):
+    """call the function behind a vm_onstack built-in, turning errors into $T"""
+    try:
+        return func(vm, *args)
+    except TypeError as e:
+        print(e)
+        return [type_error]
+    except AttributeError:
+        return [type_error]
+
+
+def vm_onstack(n, name=None, trustme=True, runs_code=False):
     """
     @vm_onstack(2)
     def moddiv(self, b, a):
@@ -65,24 +121,19 @@ def vm_onstack(n, name=None, trustme=True):
         a = self.stack_pop()
         self.stack_push(a % b)
         self.stack_push(a // b)
+
+    `runs_code` marks built-ins that may run code blocks of the program,
+    by calling them or by going through a lazy sequence. They get no
+    stack effect, because the analyser can't see what those blocks do.
     """
     def wrapper(func):
         def wrapped(vm):
             vm.register_operation()
-            args = reversed([vm.stack_pop() for _ in range(n)])
-            try:
-                ret = func(vm, *args)
-            except TypeError as e:
-                print(e)
-                vm.stack_push(type_error)
-                return
-            except AttributeError:
-                vm.stack_push(type_error)
-                return
+            args = vm.stack_pop_n(n)
+            ret = apply_onstack(vm, func, args)
 
             if ret:
-                for i in ret:
-                    vm.stack_push(i)
+                vm.stack_extend(ret)
             elif (not trustme):
                 vm.stack_push(none)
 
@@ -94,6 +145,10 @@ def vm_onstack(n, name=None, trustme=True):
 
         wrapped = withrepr(builtin_function_repr(func))(wrapped)
         wrapped.help = func.__doc__ or ""
+        wrapped.effect = None if runs_code else parse_effect(func.__doc__, n)
+        wrapped.function = func
+        wrapped.trustme = trustme
+        wrapped.runs_code = runs_code
         vm_builtins[name] = wrapped
         return wrapped
     return wrapper
@@ -102,94 +157,235 @@ def vm_onstack(n, name=None, trustme=True):
 class VM:
     def __init__(self, statements,
                  printer=print, reader=input,
-                 operations_limit=1_000_000):
-        self.statements = statements
+                 operations_limit=1_000_000,
+                 jit_threshold=None, jit_dump=False,
+                 workers=None, chunk_size=None, arithmetic="python",
+                 memory_limit=None, stats_file=None, stats_format="json"):
+        self.statements = list(statements) # the parsed ones may be shared
         self.stack = []
         self.names = {**vm_builtins}
+        # (LocalBlock, slots) of the running calls, above one that never
+        # matches, so the top can be checked without checking for empty
+        self.local_frames = [(None, None)]
+        self.name_index = PrefixTrie(self.names)
+        # code block -> what set_help gave it; kept here rather than on
+        # the block, which may be part of a program other VMs are running
+        self.help_texts = {}
         self.printer = printer
         self.reader = reader
         self.operations = 0
         self.operations_limit = operations_limit
-        self.history = []
+        # register_operation only looks further when this is passed
+        self.next_check = 0
+        self.charged_stack = 0 # the stack height last charged for
+        # operations by category, counted where they're charged; what
+        # compiled code and batched loops charge isn't, see Stats
+        self.pushes = 0
+        self.pops = 0
+        self.lookups = 0
+        self.calls = 0
+        self.assignments = 0
+        self.stack_peak = 0
+        self.call_depth = 0 # code blocks being called inside each other
+        self.call_depth_peak = 0
         self.last_result = None
-
-    def register_operation(self):
-        self.history.append(self.stack.copy())
-        if len(self.history) >= 32:
-            self.history = self.history[-32:]
-        self.operations += 1
+        self.workers = workers # for pmap and pforeach, None is one per CPU
+        self.chunk_size = chunk_size
+        self.arithmetic = get_arithmetic(arithmetic)
+        self.memory = MemoryMeter(self, memory_limit) # limit in bytes
+        self.stats = Stats()
+        self.stats_file = stats_file # written at the end of run()
+        self.stats_format = stats_format
+        if jit_threshold is None:
+            self.jit = None
+        else:
+            self.jit = Jit(self, jit_threshold, dump=jit_dump)
+
+    def snapshot(self):
+        """
+        Serialise the stack, the names and the operation count into
+        bytes that VM.restore can load. Statements aren't included.
+        """
+        state = {
+            "stack": self.stack,
+            "names": self.names,
+            "operations": self.operations,
+            "last_result": self.last_result,
+            "help_texts": self.help_texts,
+        }
+        return snapshot.dump(state, vm_builtins)
+
+    @classmethod
+    def restore(cls, data, statements=None, **kwargs):
+        state = snapshot.load(data, vm_builtins)
+        vm = cls([] if statements is None else statements, **kwargs)
+        vm.stack = state["stack"]
+        vm.names = state["names"]
+        vm.name_index = PrefixTrie(vm.names)
+        vm.operations = state["operations"]
+        vm.last_result = state["last_result"]
+        vm.help_texts = state.get("help_texts", {}) # older snapshots
+        return vm
+
+    def allocate(self, size, building=0):
+        """
+        note that about `size` bytes have been or are about to be used;
+        `building` more are in a value that is still being made, which
+        a walk can't reach yet
+        """
+        memory = self.memory
+        memory.allocated += size
+        if memory.allocated > memory.next_walk:
+            memory.walk(incoming=size + building)
+
+    def allocate_list(self, length):
+        """allocate() for a list of `length` items that's about to be made"""
+        self.allocate(EMPTY_LIST + POINTER * length)
+
+    def listed(self, items):
+        """
+        A new list of the items, charged for before it's made. Lazy
+        sequences and ranges don't know their length, so their list is
+        charged for a chunk at a time as it grows, and a long one stops
+        at the memory limit rather than after it has been made.
+        """
+        if hasattr(items, "__len__"):
+            self.allocate_list(len(items))
+            return list(items)
+        listed = []
+        iterator = iter(items)
+        while True:
+            chunk = list(itertools.islice(iterator, LIST_CHUNK))
+            if not chunk:
+                return listed
+            self.allocate(POINTER * len(chunk),
+                          building=EMPTY_LIST + POINTER * len(listed))
+            listed.extend(chunk)
+
+    def allocated(self, value):
+        """allocate() for a value that was just made, returns the value"""
+        self.allocate(sys.getsizeof(value))
+        return value
+
+    def register_operation(self, count=1):
+        self.operations += count
+        if self.operations > self.next_check:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Every so many operations: stop at the operations limit, and
+        charge for what the stack has grown by since the last time, so
+        pushing one value at a time stops at the memory limit too
+        """
         if self.operations > self.operations_limit:
             raise Exception("Too many operations")
+        height = len(self.stack)
+        if height > self.charged_stack:
+            self.allocate(POINTER * (height - self.charged_stack))
+        self.charged_stack = height
+        self.next_check = min(self.operations_limit,
+                              self.operations + STACK_CHECK_EVERY)
 
     @vm_onstack(2, name="or")
     def _or(self, a, b):
+        """a b -- a|b"""
         return [int(a or b)]
 
     @vm_onstack(2, name="and")
     def _and(self, a, b):
+        """a b -- a&b"""
         return [int(a and b)]
 
     @vm_onstack(1, name="not")
     def _not(self, x):
+        """a -- !a"""
         return [int(not x)]
 
     @vm_onstack(1)
     def parse_int(self, source):
-        T = ensure_types((source, (str, float, int)))
+        """string -- int"""
+        T = ensure_types((source, (str, Rope, float, int)))
         if not T:
             return [T]
 
         try:
-            return [int(source)]
+            return [int(flatten(source))]
         except ValueError:
             return [error]
 
     @vm_onstack(2, name="+")
     def add(self, a, b):
+        """a b -- a+b"""
         return [ensure_numbers(a, b) and a + b]
 
     @vm_onstack(2, name="-")
     def sub(self, a, b):
+        """a b -- a-b"""
         return [ensure_numbers(a, b) and a - b]
 
     @vm_onstack(2, name="*")
     def mul(self, a, b):
-        return [a * b]
+        """a b -- a*b"""
+        a, b = flatten(a), flatten(b) # a long ++ result repeats as a string
+        if type(a) in SEQUENCES or type(b) in SEQUENCES:
+            # repeating a sequence can make a huge one at once
+            sequence, count = (a, b) if type(a) in SEQUENCES else (b, a)
+            if type(count) is int and count > 1:
+                # the header, and what the items take, count times
+                empty = sys.getsizeof(sequence[:0])
+                self.allocate(empty
+                              + (sys.getsizeof(sequence) - empty) * count)
+        return [self.arithmetic.mul(a, b)]
 
     @vm_onstack(2, name="mod")
     def mod(self, a, b):
-        return [a % b]
+        """a b -- a%b"""
+        return [self.arithmetic.mod(a, b)]
 
     @vm_onstack(2, name="/f")
     def fdiv(self, a, b):
+        """a b -- a/b"""
         return [a / b]
 
     @vm_onstack(2, name="/i")
     def idiv(self, a, b):
-        return [a // b]
+        """a b -- a//b"""
+        return [self.arithmetic.floordiv(a, b)]
+
+    @vm_onstack(3)
+    def powmod(self, base, exponent, modulus):
+        """base exponent modulus -- base^exponent%modulus"""
+        return [self.arithmetic.powmod(base, exponent, modulus)]
 
     @vm_onstack(2, name="=")
     def eq(self, a, b):
+        """a b -- a=b"""
         return [int(a == b)]
 
     @vm_onstack(2, name="!=")
     def neq(self, a, b):
+        """a b -- a!=b"""
         return [int(a != b)]
 
     @vm_onstack(2, name="<")
     def lt(self, a, b):
+        """a b -- a<b"""
         return [int(a < b)]
 
     @vm_onstack(2, name=">")
     def gt(self, a, b):
+        """a b -- a>b"""
         return [int(a > b)]
 
     @vm_onstack(2, name="<=")
     def le(self, a, b):
+        """a b -- a<=b"""
         return [int(a <= b)]
 
     @vm_onstack(2, name=">=")
     def ge(self, a, b):
+        """a b -- a>=b"""
         return [int(a >= b)]
 
     @vm_onstack(1)
@@ -198,18 +394,18 @@ class VM:
 
     @vm_builtin
     def grab(self) -> '$N a b c... -- [..., c, b, a]':
-        grabbed = []
-        while True:
-            x = self.stack_pop()
-            if x == none:
-                self.stack_push(grabbed)
-                break
-            else:
-                grabbed.append(x)
+        grabbed = self.stack_pop_to(none)
+        grabbed.reverse()
+        self.stack_push(self.allocated(grabbed))
 
-    @vm_onstack(2)
+    @vm_onstack(2, runs_code=True)
     def str_join(self, string, list_):
-        return [string.join(map(str, list_))]
+        """separator [a, b, ...] -- string"""
+        string = flatten(string)
+        parts = self.listed(map(str, list_))
+        self.allocate(EMPTY_STR + sum(map(len, parts))
+                      + len(string) * max(len(parts) - 1, 0))
+        return [string.join(parts)]
 
     ["Strings"]
 
@@ -219,45 +415,73 @@ class VM:
 
     @vm_onstack(1, name="chr")
     def chr_(self, code):
+        """code -- string"""
         return [chr(code)]
 
     ["I/O"]
 
     @vm_onstack(0)
     def read(self):
-        return [self.reader()]
+        """ -- string"""
+        return [self.allocated(self.reader())]
+
+    @vm_onstack(0)
+    def lines(self):
+        """ -- lines"""
+        def items():
+            while True:
+                try:
+                    line = self.reader()
+                except EOFError:
+                    return
+                yield line
+        return [Lazy(items, "lines")]
 
     @vm_onstack(1)
     def print(self, x):
-        self.printer(x, end='')
+        """a -- """
+        self.write(x, end='')
 
     @vm_onstack(1)
     def println(self, x):
-        self.printer(x, end='\n')
+        """a -- """
+        self.write(x, end='\n')
+
+    def write(self, x, end):
+        if isinstance(x, Rope):
+            # a part at a time, without joining the whole string
+            for part in x.chunks():
+                self.printer(part, end='')
+            self.printer('', end=end)
+        else:
+            self.printer(x, end=end)
 
     ["Containers"]
 
-    @vm_onstack(2)
+    @vm_onstack(2, runs_code=True)
     def contains(self, container, item):
-        return [int(item in container)]
+        """container item -- 0|1"""
+        return [int(flatten(item) in container)]
 
     @vm_onstack(1)
     def rev(self, container):
         """[a, b, ..., c, d] -- [d, c, ..., b, a]"""
-        return [container[::-1]]
+        return [self.allocated(container[::-1])]
 
     @vm_onstack(1, name="len")
     def len_(self, container):
+        """container -- length"""
         return [len(container)]
 
-    @vm_onstack(1, name="sum")
+    @vm_onstack(1, name="sum", runs_code=True)
     def sum_(self, container):
+        """container -- sum"""
         return [sum(container)]
 
     @vm_onstack(2)
     def push(self, x, list_):
         """[..., a] b -- [..., a, b]"""
-        return [list_ + [x]]
+        return [self.allocated(list_ + [x])]
 
     @vm_onstack(1)
     def last(self, container):
@@ -303,7 +527,7 @@ class VM:
     @vm_onstack(1)
     def as_src(self, code):
         """convert code block to stekk source"""
-        return [code.str_rec()]
+        return [self.allocated(str_rec(code))]
 
     @vm_onstack(2, name="++")
     def concat(self, left, right):
@@ -312,36 +536,208 @@ class VM:
             return [ensure_types(
                         (left, CodeBlock),
                         (right, CodeBlock)
-                    ) and CodeBlock(left.stmts + right.stmts)]
+                    ) and self.allocated(CodeBlock(left.stmts + right.stmts))]
+        elif isinstance(left, (str, Rope)) and isinstance(right, (str, Rope)):
+            self.allocate(len(right) + sys.getsizeof(""))
+            return [concat(left, right)]
         else:
             return [ensure_types(
                         (left, (str, list))
-                    ) and left + right]
+                    ) and self.allocated(left + right)]
 
     @vm_onstack(1, name="--")
     def codesplit(self, code: CodeBlock):
         """convert a code block into a list of one-statement code blocks"""
-        return [[CodeBlock([stmt]) for stmt in code.stmts]]
+        return [self.allocated([CodeBlock([stmt]) for stmt in code.stmts])]
 
     ["Functional stuff"]
 
     @vm_onstack(1, name="help")
     def help_(self, function):
+        """function -- string"""
+        if isinstance(function, CodeBlock):
+            return [self.help_texts.get(function, function.help)]
         return [function.help]
 
     @vm_onstack(2, name="set_help")
     def set_help(self, code_block, string):
+        """code string -- code"""
         if not isinstance(code_block, CodeBlock):
             raise TypeError
-        code_block.help = string
+        self.help_texts[code_block] = string
         return [code_block]
 
     @vm_onstack(2)
     def foreach(self, iterable, function):
+        # one at a time, so lazy sequences stream and the operations
+        # limit stops the loop where the items are too many
         for item in iterable:
             self.stack_push(item)
             self.function_call(function)
 
+    @vm_onstack(2)
+    def times(self, count, function):
+        """call a function count times, .break stops early"""
+        self.loop(range(count), function, push=False)
+
+    @vm_onstack(2, name="for")
+    def for_(self, numbers, function):
+        """call a function with each number of a range on the stack,
+        .break stops early"""
+        if not isinstance(numbers, Range):
+            raise TypeError("for needs a range")
+        self.loop(range(numbers.left, numbers.right + 1), function, push=True)
+
+    @vm_builtin_as("break")
+    def break_(self):
+        """stop the innermost times or for loop"""
+        raise LoopBreak
+
+    @vm_onstack(2, runs_code=True)
+    def pmap(self, iterable, function):
+        """[a, b, ...] f -- [results]"""
+        # the calls run in worker processes, see parallel.py
+        calls = run_parallel(self, function, self.listed(iterable), vm_builtins)
+        # what call_with would give for each item
+        return [self.allocated([
+            result if result is not None else stack[-1] if stack else none
+            for stack, result in calls])]
+
+    @vm_onstack(2, runs_code=True)
+    def pforeach(self, iterable, function):
+        """foreach in worker processes, each call starting on a stack
+        holding only its item"""
+        calls = run_parallel(self, function, self.listed(iterable), vm_builtins)
+        return [value for stack, _ in calls for value in stack]
+
+    ["Lazy sequences"]
+
+    def call_with(self, function, *args):
+        """what (args .function) would leave on top of the stack"""
+        self.stack_extend(args)
+        result = self.function_call(function)
+        if result is None:
+            return self.stack_pop()
+        return result
+
+    @vm_onstack(2, name="map", runs_code=True)
+    def map_(self, items, function):
+        """items f -- lazy"""
+        return [Lazy(lambda: (self.call_with(function, item)
+                              for item in items), "map")]
+
+    @vm_onstack(2, name="filter", runs_code=True)
+    def filter_(self, items, function):
+        """items f -- lazy"""
+        return [Lazy(lambda: (item for item in items
+                              if self.call_with(function, item)), "filter")]
+
+    @vm_onstack(2, runs_code=True)
+    def take(self, items, count):
+        """items count -- lazy"""
+        if type(count) is not int:
+            raise TypeError("take needs a count")
+        return [Lazy(lambda: itertools.islice(items, max(count, 0)), "take")]
+
+    @vm_onstack(2, name="zip", runs_code=True)
+    def zip_(self, left, right):
+        """items items -- lazy"""
+        return [Lazy(lambda: ([a, b] for a, b in zip(left, right)), "zip")]
+
+    @vm_onstack(1, name="enumerate", runs_code=True)
+    def enumerate_(self, items):
+        """items -- lazy"""
+        return [Lazy(lambda: ([i, item] for i, item in enumerate(items)),
+                     "enumerate")]
+
+    @vm_onstack(3, runs_code=True)
+    def reduce(self, items, initial, function):
+        """items initial f -- result"""
+        result = initial
+        for item in items:
+            result = self.call_with(function, result, item)
+        return [result]
+
+    @vm_onstack(1, runs_code=True)
+    def collect(self, items):
+        """items -- [items]"""
+        return [self.listed(items)]
+
+    ["Sorting and searching"]
+
+    def keys_of(self, items, function):
+        """what the function gives for each item, calling it once per item"""
+        self.allocate_list(len(items))
+        return [self.call_with(function, item) for item in items]
+
+    @vm_onstack(1, runs_code=True)
+    def sort(self, items):
+        """items -- [sorted]"""
+        items = self.listed(items)
+        items.sort()
+        return [items]
+
+    @vm_onstack(2, runs_code=True)
+    def sort_by(self, items, function):
+        """items f -- [sorted by what f gives for them]"""
+        # the keys are worked out first, and the indices sorted by them,
+        # so items with equal keys keep their order and are never compared
+        items = self.listed(items)
+        keys = self.keys_of(items, function)
+        self.allocate_list(2 * len(items)) # the order and the result
+        order = sorted(range(len(items)), key=keys.__getitem__)
+        return [[items[i] for i in order]]
+
+    @vm_onstack(2)
+    def bsearch(self, sorted_, item):
+        """[sorted] item -- index|$N"""
+        index = bisect.bisect_left(sorted_, item)
+        if index < len(sorted_) and sorted_[index] == item:
+            return [index]
+        return [none]
+
+    @vm_onstack(1, runs_code=True)
+    def uniq(self, items):
+        """items -- [items without repeats, first ones kept]"""
+        items = self.listed(items) # gone through twice if there are lists
+        self.allocate_list(len(items)) # at most all of them
+        try:
+            return [list(dict.fromkeys(items))]
+        except TypeError: # lists among the items
+            pass
+        seen = set()
+        unique = []
+        for item in items:
+            key = hash_key(item)
+            if key not in seen:
+                seen.add(key)
+                unique.append(item)
+        return [unique]
+
+    @vm_onstack(1, name="set", runs_code=True)
+    def set_(self, items):
+        """items -- set; contains on it doesn't slow down with size"""
+        if not hasattr(items, "__len__"):
+            items = self.listed(items)
+        self.allocate(sys.getsizeof(set()) + SET_ITEM * len(items))
+        return [set(items)]
+
+    @vm_onstack(2, runs_code=True)
+    def group_by(self, items, function):
+        """items f -- [[key [items with that key]] ...]"""
+        items = self.listed(items)
+        keys = self.keys_of(items, function)
+        self.allocate_list(len(items)) # the items, in their groups
+        groups = {}
+        for key, item in zip(keys, items):
+            group = groups.get(hash_key(key))
+            if group is None:
+                self.allocate(2 * EMPTY_LIST + 2 * POINTER)
+                group = groups[hash_key(key)] = [key, []]
+            group[1].append(item)
+        self.allocate_list(len(groups))
+        return [list(groups.values())]
+
     ["Metaprogramming"]
 
     @vm_onstack(1, name="eval")
@@ -351,11 +747,15 @@ class VM:
 
     @vm_onstack(1, name="import")
     def import_(self, module_name):
+        module_name = flatten(module_name)
         with open(module_name + ".stekk") as file:
             source = file.read()
+        start = time.perf_counter()
         statements = parse(source)
+        self.stats.parse_time += time.perf_counter() - start
+        self.stats.modules.append(module_name)
         _, stripped_name = os.path.split(module_name)
-        self.names[stripped_name] = CodeBlock(statements)
+        self.bind_name(stripped_name, Namespace(statements))
         return [self.names[stripped_name]]
 
 
@@ -366,7 +766,7 @@ class VM:
             if isinstance(v, int):
                 # (1, 2) -> [(1, 2)]
                 lst.append(v)
-            elif isinstance(v, RangeExpr):
+            elif isinstance(v, Range):
                 # (1..3, 2) -> [(1, 2), (2, 2), (3, 2)]
                 left = v.left
                 right = v.right
@@ -389,19 +789,66 @@ class VM:
                     yield (px, py)
 
     def at_to_list(self, at_expr):
-        return list(self.points_from_region(at_expr))
+        return self.listed(self.points_from_region(at_expr))
 
 
     def function_call(self, func):
         self.register_operation()
-        func = get_value(func, self)
+        self.calls += 1
+        return self.call(get_value(func, self))
+
+    def call(self, func):
+        """call an evaluated function, without charging for the call"""
         if isinstance(func, CodeBlock):
-            return func.run(self)
+            self.call_depth += 1
+            if self.call_depth > self.call_depth_peak:
+                self.call_depth_peak = self.call_depth
+            try:
+                if self.jit is not None:
+                    compiled = self.jit.compiled_block(func)
+                    if compiled is not None:
+                        return compiled(self)
+                return func.run(self)
+            finally:
+                self.call_depth -= 1
         else:
             return func(self)
 
+    def loop(self, indices, function, push):
+        """
+        Call the function once per index, pushing the index first if
+        `push` is set. The function and the way it's called are looked up
+        once, and the calls and pushes are charged in batches.
+        """
+        call = self.call
+        function = get_value(function, self)
+        cost = 2 if push else 1
+        pending = 0
+        stack = self.stack
+        try:
+            for index in indices:
+                if pending >= LOOP_BATCH:
+                    self.register_operation(pending)
+                    pending = 0
+                pending += cost
+                if push:
+                    stack.append(index)
+                    self.pushes += 1
+                    if len(stack) > self.stack_peak:
+                        self.stack_peak = len(stack)
+                call(function)
+        except LoopBreak:
+            pass
+        self.register_operation(pending)
+
     def run(self):
-        self.execute_statements(self.statements)
+        start = time.perf_counter()
+        try:
+            self.execute_statements(self.statements)
+        finally:
+            self.stats.wall_time += time.perf_counter() - start
+            if self.stats_file is not None:
+                self.stats.export(self, self.stats_file, self.stats_format)
 
     def execute_statements(self, statements):
         for stmt in statements:
@@ -413,14 +860,32 @@ class VM:
 
     def assign_name(self, name, value):
         self.register_operation()
+        self.assignments += 1
+        self.bind_name(name, value)
+
+    def bind_name(self, name, value):
+        if name not in self.names:
+            self.name_index.add(name)
+        elif isinstance(self.names[name], (CodeBlock, StrWrapper)):
+            # compiled code may depend on the old function
+            if self.jit is not None:
+                self.jit.invalidate(name)
         self.names[name] = value
 
+    def names_with_prefix(self, prefix):
+        if len(self.name_index) != len(self.names):
+            # somebody wrote to self.names directly
+            self.name_index = PrefixTrie(self.names)
+        return self.name_index.with_prefix(prefix)
+
     def setitem(self, obj, index, value):
         self.register_operation()
         obj[index] = value
 
     def getitem(self, obj, index):
-        if isinstance(obj, CodeBlock):
+        if isinstance(obj, Namespace) and isinstance(index, Const):
+            return obj.member(index.name, self)
+        elif isinstance(obj, CodeBlock):
             if isinstance(index, int):
                 return get_value(obj.stmts[index], self)
             elif isinstance(index, Const):
@@ -437,15 +902,117 @@ class VM:
 
     def get_name(self, name):
         self.register_operation()
+        self.lookups += 1
         return self.names[name]
 
+    def local_slots(self, scope, slot):
+        """
+        The slots of the latest running call of `scope`. That's usually
+        the top frame, but blocks inside it, like loop bodies, may have
+        locals of their own.
+        """
+        for block, slots in reversed(self.local_frames):
+            if block is scope:
+                return slots
+        raise KeyError(f"{scope.slots[slot]} is local to a block that "
+                       "isn't running")
+
+    def get_local(self, scope, slot):
+        self.register_operation()
+        self.lookups += 1
+        block, slots = self.local_frames[-1]
+        if block is not scope:
+            slots = self.local_slots(scope, slot)
+        value = slots[slot]
+        if value is None:
+            raise KeyError(scope.slots[slot])
+        return value
+
+    def assign_local(self, scope, slot, value):
+        self.register_operation()
+        self.assignments += 1
+        block, slots = self.local_frames[-1]
+        if block is not scope:
+            slots = self.local_slots(scope, slot)
+        slots[slot] = value
+
     def stack_push(self, x):
         self.register_operation()
-        self.stack.append(x)
+        self.pushes += 1
+        stack = self.stack
+        stack.append(x)
+        if len(stack) > self.stack_peak:
+            self.stack_peak = len(stack)
 
     def stack_pop(self):
         self.register_operation()
+        self.pops += 1
         if self.stack:
             return self.stack.pop()
         else:
             return none
+
+    def stack_extend(self, values):
+        """push all values, the last one ends up on top"""
+        stack = self.stack
+        size = len(stack)
+        stack.extend(values)
+        added = len(stack) - size
+        self.register_operation(added)
+        self.pushes += added
+        if len(stack) > self.stack_peak:
+            self.stack_peak = len(stack)
+        self.allocate(8 * added)
+
+    def stack_pop_n(self, n):
+        """
+        pop n values at once, returns them in stack order (the top one
+        last) with $N in place of the ones missing from the stack
+        """
+        self.register_operation(n)
+        self.pops += n
+        stack = self.stack
+        if n == 0:
+            return []
+        if n <= len(stack):
+            values = stack[-n:]
+            del stack[-n:]
+        else:
+            values = [none] * (n - len(stack)) + stack
+            stack.clear()
+        return values
+
+    def stack_pop_to(self, sentinel):
+        """
+        pop the values above the topmost `sentinel`, and the sentinel.
+        Returns the values in stack order. Without a sentinel, the whole
+        stack is popped.
+        """
+        stack = self.stack
+        # search backwards in growing chunks, so a sentinel near the top
+        # is found without copying the whole stack
+        end = len(stack)
+        size = 64
+        index = -1
+        while end > 0:
+            start = max(0, end - size)
+            chunk = stack[start:end]
+            chunk.reverse()
+            try:
+                index = end - 1 - chunk.index(sentinel)
+                break
+            except ValueError:
+                end = start
+                size *= 2
+
+        values = stack[index + 1:]
+        # as many pops as one at a time would take, including the last one
+        self.register_operation(len(values) + 1)
+        self.pops += len(values) + 1
+        del stack[max(index, 0):]
+        return values
+
+
+# filled in by the decorators of the built-ins; every VM, in any thread,
+# reads it, so nothing may change it from here on
+vm_builtins = types.MappingProxyType(vm_builtins)